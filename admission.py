@@ -0,0 +1,264 @@
+"""
+Admission control in front of upstream model calls. Every call waits for
+a slot: its endpoint's concurrency limit plus shared per-minute budgets
+of requests, input tokens and output tokens, kept as token buckets the
+way the API's own rate limits are. Waiting calls are admitted by priority
+class, so interactive chat goes ahead of bulk OCR and document analysis,
+and a call that cannot be admitted within its deadline fails with
+Overloaded (HTTP 503) instead of adding to a wave of upstream 429s.
+
+Budgets are per process: with several workers, divide the organization's
+limits between them.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import math
+from contextlib import asynccontextmanager
+from time import monotonic
+
+import metrics
+from config import env_vars
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Per-minute budgets shared by all endpoints; 0 means no limit
+ADMISSION_RPM = float(env_vars.get("ADMISSION_RPM") or 0)
+ADMISSION_INPUT_TPM = float(env_vars.get("ADMISSION_INPUT_TPM") or 0)
+ADMISSION_OUTPUT_TPM = float(env_vars.get("ADMISSION_OUTPUT_TPM") or 0)
+# Longest a call waits for admission before failing, per priority class
+ADMISSION_DEADLINES = {
+    INTERACTIVE: float(env_vars.get("ADMISSION_DEADLINE_INTERACTIVE") or 15),
+    BULK: float(env_vars.get("ADMISSION_DEADLINE_BULK") or 120),
+}
+# Calls beyond this many already waiting are refused at once
+ADMISSION_MAX_QUEUE = int(env_vars.get("ADMISSION_MAX_QUEUE") or 1000)
+# Input tokens assumed for a file or image block until the call reports its usage
+FILE_TOKEN_ESTIMATE = int(env_vars.get("ADMISSION_FILE_TOKEN_ESTIMATE") or 3000)
+
+ADMISSION_EVENTS = metrics.Counter(
+    "gpslaw_admission_events_total",
+    "Upstream calls admitted at once, admitted after queueing, or refused (queue full or deadline passed).",
+    ("endpoint", "event"),
+)
+
+
+class Overloaded(Exception):
+    """No upstream capacity for this call within its deadline."""
+
+
+class TokenBucket:
+    """
+    `per_minute` tokens refilled continuously, holding at most one
+    minute's worth. Taking more than is left is allowed once the bucket is
+    full (a single call may be larger than the budget) and settling may
+    push it below zero; later calls then wait for the debt to refill.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken; 0 if it can be now."""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        if self.capacity > 0:
+            self._refill()
+            self.tokens -= amount
+
+    def give(self, amount: float) -> None:
+        if self.capacity > 0:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Ticket:
+    """An admitted call. `settle` corrects the token reservation with the real usage."""
+
+    def __init__(self, input_tokens: int, output_tokens: int):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+class Scheduler:
+    def __init__(self, rpm: float, input_tpm: float, output_tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.input_tokens = TokenBucket(input_tpm)
+        self.output_tokens = TokenBucket(output_tpm)
+        # endpoint -> [concurrency limit, calls in flight, priority class]
+        self.endpoints = {}
+        # (priority, arrival, endpoint, ticket, future) of waiting calls
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._timer = None
+
+    def configure(self, endpoint: str, concurrency: int, priority: int) -> None:
+        """Set an endpoint's concurrency limit (0 for none) and priority class."""
+        concurrency = concurrency if concurrency > 0 else math.inf
+        state = self.endpoints.setdefault(endpoint, [concurrency, 0, priority])
+        state[0] = concurrency
+        state[2] = priority
+
+    @asynccontextmanager
+    async def admit(self, endpoint: str, input_tokens: int, output_tokens: int):
+        """
+        Hold a slot for one upstream call of `endpoint`, reserving
+        `input_tokens` and `output_tokens` (the call's max_tokens) from
+        the budgets. Raises Overloaded if none frees up in time.
+        """
+        state = self.endpoints.setdefault(endpoint, [math.inf, 0, BULK])
+        ticket = Ticket(input_tokens, output_tokens)
+        if not self._queue and self._can_admit(state, ticket) == 0:
+            self._start(state, ticket)
+            ADMISSION_EVENTS.inc(endpoint=endpoint, event="admitted")
+        else:
+            await self._wait(endpoint, state, ticket)
+        try:
+            yield ticket
+        finally:
+            state[1] -= 1
+            self._dispatch()
+
+    def settle(self, ticket: Ticket, usage) -> None:
+        """Replace a ticket's token estimates with the usage the API reported."""
+        used_input = usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", 0) or 0)
+        self.input_tokens.give(ticket.input_tokens - used_input)
+        self.output_tokens.give(ticket.output_tokens - usage.output_tokens)
+        ticket.input_tokens = used_input
+        ticket.output_tokens = usage.output_tokens
+
+    def queued(self) -> dict:
+        """Number of waiting calls per priority class."""
+        counts = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+        for priority, _, _, _, future in self._queue:
+            if not future.done():
+                counts[PRIORITY_NAMES[priority]] += 1
+        return counts
+
+    async def _wait(self, endpoint: str, state: list, ticket: Ticket) -> None:
+        priority = state[2]
+        if len(self._queue) >= ADMISSION_MAX_QUEUE:
+            ADMISSION_EVENTS.inc(endpoint=endpoint, event="queue_full")
+            raise Overloaded(f"{endpoint}: admission queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrivals), endpoint, ticket, future))
+        self._dispatch()
+        try:
+            with metrics.span(endpoint, "admission_wait"):
+                await asyncio.wait_for(future, ADMISSION_DEADLINES[priority])
+        except asyncio.TimeoutError:
+            ADMISSION_EVENTS.inc(endpoint=endpoint, event="deadline_exceeded")
+            raise Overloaded(
+                f"{endpoint}: no upstream capacity within {ADMISSION_DEADLINES[priority]:g}s"
+            ) from None
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller went away: pass the slot on
+                state[1] -= 1
+                self._dispatch()
+            raise
+        ADMISSION_EVENTS.inc(endpoint=endpoint, event="admitted_after_wait")
+
+    def _can_admit(self, state: list, ticket: Ticket):
+        """0 if the call can start now, None if its endpoint is full, else seconds until the budgets allow it."""
+        if state[1] >= state[0]:
+            return None
+        return max(
+            self.requests.wait_time(1),
+            self.input_tokens.wait_time(ticket.input_tokens),
+            self.output_tokens.wait_time(ticket.output_tokens),
+        )
+
+    def _start(self, state: list, ticket: Ticket) -> None:
+        state[1] += 1
+        self.requests.take(1)
+        self.input_tokens.take(ticket.input_tokens)
+        self.output_tokens.take(ticket.output_tokens)
+
+    def _dispatch(self) -> None:
+        """
+        Admit waiting calls in priority order. A call whose endpoint is
+        full is passed over; one that the shared budgets cannot cover yet
+        holds back everything behind it, so bulk calls never use up the
+        budget a waiting chat call needs.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        skipped = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            _, _, endpoint, ticket, future = entry
+            if future.done():
+                # Gave up waiting
+                continue
+            wait = self._can_admit(self.endpoints[endpoint], ticket)
+            if wait is None:
+                skipped.append(entry)
+                continue
+            if wait > 0:
+                skipped.append(entry)
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                break
+            self._start(self.endpoints[endpoint], ticket)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+
+def estimate_input_tokens(params: dict) -> int:
+    """Rough input size of Messages API parameters: ~4 characters per token, FILE_TOKEN_ESTIMATE per file."""
+    files = 0
+    chars = len(json.dumps(params.get("system", "")))
+    for message in params.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for block in content:
+            if block.get("source", {}).get("type") == "file":
+                files += 1
+            else:
+                chars += len(json.dumps(block))
+    return chars // 4 + files * FILE_TOKEN_ESTIMATE
+
+
+scheduler = Scheduler(ADMISSION_RPM, ADMISSION_INPUT_TPM, ADMISSION_OUTPUT_TPM)
+
+
+@asynccontextmanager
+async def admit(endpoint: str, params: dict):
+    """scheduler.admit for one call with these Messages API parameters."""
+    async with scheduler.admit(endpoint, estimate_input_tokens(params), params.get("max_tokens", 0)) as ticket:
+        yield ticket
+
+
+def settle(ticket: Ticket, usage) -> None:
+    scheduler.settle(ticket, usage)
+
+
+def admission_metrics() -> list[str]:
+    lines = ["# TYPE gpslaw_admission_queued gauge"]
+    for priority, count in scheduler.queued().items():
+        lines.append(f'gpslaw_admission_queued{{priority="{priority}"}} {count}')
+    return lines
+
+
+metrics.register_collector(admission_metrics)
@@ -1,45 +1,172 @@
+import asyncio
 import json
 import os
+import threading
+import weakref
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime, timezone
 from time import time
+from typing import Annotated
 import uuid
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from dotenv import dotenv_values
-import anthropic
+from fastapi import APIRouter, FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, StringConstraints
 import random
-
-env_vars = dotenv_values(".env")
-import re
-
-client = anthropic.Anthropic(api_key=env_vars.get("ANTROPIC_API_KEY"))
-
-app = FastAPI(title="GpsLaw.AI Chat API")
+import admission
+import clients
+import content_cache
+import legal_context
+import metrics
+import resilience
+from config import env_vars
+import session_store
+import small_talk
+from session_cache import CachedSessionStore
+from response_decoder import PartialReplyParser, ResponseDecodeError, decode_response, response_model
 
 SESSIONS_FILE = "chat_sessions.json"
-
-
-def load_sessions():
-    """Load all chat sessions from file."""
-    if os.path.exists(SESSIONS_FILE):
-        with open(SESSIONS_FILE, "r") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-def save_sessions(sessions):
-    """Save all chat sessions to file."""
-    with open(SESSIONS_FILE, "w") as f:
-        json.dump(sessions, f, indent=2)
-
-def get_or_create_session(sessions, session_id=None):
-    """Return existing session if found, otherwise create a new one."""
-    if session_id and session_id in sessions:
-        return session_id
+SESSIONS_DB = env_vars.get("SESSIONS_DB") or session_store.SESSIONS_DB
+
+# Sessions idle for SESSION_ARCHIVE_AFTER seconds are compressed into cold
+# storage every SESSION_ARCHIVE_INTERVAL seconds; 0 disables archiving
+SESSION_ARCHIVE_AFTER = float(env_vars.get("SESSION_ARCHIVE_AFTER") or 7 * 24 * 3600)
+SESSION_ARCHIVE_INTERVAL = float(env_vars.get("SESSION_ARCHIVE_INTERVAL") or 3600)
+# Chat is interactive: admitted ahead of OCR and document analysis when
+# upstream capacity is short. It is only held back by the shared budgets
+# unless CHAT_CONCURRENCY caps its calls in flight (0 means no cap)
+CHAT_CONCURRENCY = int(env_vars.get("CHAT_CONCURRENCY") or 0)
+admission.scheduler.configure("/chat", CHAT_CONCURRENCY, admission.INTERACTIVE)
+admission.scheduler.configure("/chat/stream", CHAT_CONCURRENCY, admission.INTERACTIVE)
+SESSIONS_ARCHIVED = metrics.Counter("gpslaw_sessions_archived_total", "Idle chat sessions moved to cold storage.")
+
+# Prior turns sent verbatim are capped at roughly this many tokens; older
+# turns are dropped HISTORY_DROP_STEP at a time and condensed into a note
+HISTORY_TOKEN_BUDGET = int(env_vars.get("CHAT_HISTORY_TOKEN_BUDGET") or 8000)
+HISTORY_DROP_STEP = int(env_vars.get("CHAT_HISTORY_DROP_STEP") or 4)
+HISTORY_SUMMARY_TOKEN_BUDGET = int(env_vars.get("CHAT_HISTORY_SUMMARY_TOKEN_BUDGET") or 1000)
+# Sent in place of a blank stored message (the API rejects empty text) so turns still alternate
+EMPTY_TURN_TEXT = "(no message)"
+
+# Questioning turns (Phase 1 and 2) go to a small model with a short
+# budget and no tools; the guidance turn and anything after it gets the
+# full model with web search
+WEB_SEARCH_TOOL = {"type": "web_search_20260209", "name": "web_search"}
+QUESTION_ROUTE = {
+    "model": env_vars.get("CHAT_QUESTION_MODEL") or "claude-haiku-4-5",
+    "max_tokens": int(env_vars.get("CHAT_QUESTION_MAX_TOKENS") or 1024),
+}
+GUIDANCE_ROUTE = {
+    "model": env_vars.get("CHAT_GUIDANCE_MODEL") or "claude-sonnet-4-5",
+    "max_tokens": int(env_vars.get("CHAT_GUIDANCE_MAX_TOKENS") or 8192),
+    "tools": [WEB_SEARCH_TOOL],
+}
+# Guidance turns for a jurisdiction with enough cached web-search results
+# get them in the prompt next to the web_search tool (see legal_context)
+SEARCH_CACHE_ENABLED = (env_vars.get("CHAT_SEARCH_CACHE") or "1") != "0"
+SEARCH_CONTEXT_MIN_RESULTS = int(env_vars.get("SEARCH_CONTEXT_MIN_RESULTS") or 3)
+SEARCH_CONTEXT_MAX_CHARS = int(env_vars.get("SEARCH_CONTEXT_MAX_CHARS") or 6000)
+SEARCH_CACHE_LOOKUPS = metrics.Counter(
+    "gpslaw_search_cache_lookups_total", "Guidance turns by whether cached search results were added to the prompt.", ("result",)
+)
+CHAT_ROUTES = metrics.Counter(
+    "gpslaw_chat_routes_total", "Chat model calls by conversation phase and model.", ("endpoint", "phase", "model")
+)
+
+# Pure greetings and "who are you" opening a session get a canned reply without a model call
+FAST_PATH_ENABLED = (env_vars.get("CHAT_FAST_PATH") or "1") != "0"
+FAST_PATH_REPLIES = metrics.Counter(
+    "gpslaw_chat_fast_path_replies_total", "Chat turns answered without a model call.", ("endpoint", "intent")
+)
+
+_store = None
+_store_lock = threading.Lock()
+# session_id -> asyncio.Lock held for a whole turn; entries vanish once no turn holds them
+_session_locks = weakref.WeakValueDictionary()
+
+
+def get_store() -> CachedSessionStore:
+    """
+    Session store, opened by the router lifespan or else on first use.
+    Opening it is blocking sqlite work: call this from a worker thread.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store = CachedSessionStore(
+                session_store.SqliteSessionStore(SESSIONS_DB),
+                max_sessions=int(env_vars.get("SESSION_CACHE_MAX_SESSIONS") or 1000),
+                ttl=float(env_vars.get("SESSION_CACHE_TTL") or 300),
+                max_bytes=int(env_vars.get("SESSION_CACHE_MAX_BYTES") or 64 * 1024 * 1024),
+                # Set to 1 when several workers serve the same sessions
+                revalidate=(env_vars.get("SESSION_CACHE_REVALIDATE") or "0") != "0",
+            )
+            if os.path.exists(SESSIONS_FILE):
+                # Imports the legacy JSON sessions unless the database records that
+                # it already has; a failure is raised again on every call until it works
+                try:
+                    session_store.migrate_json_sessions(store.backend, SESSIONS_FILE)
+                except BaseException:
+                    store.close()
+                    raise
+            _store = store
+        return _store
+
+
+async def archive_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_ARCHIVE_INTERVAL)
+        try:
+            archived = await asyncio.to_thread(lambda: get_store().archive_idle(SESSION_ARCHIVE_AFTER))
+        except Exception as e:
+            print(f"Session archiving failed: {e}")
+            continue
+        if archived:
+            SESSIONS_ARCHIVED.inc(archived)
+            print(f"Archived {archived} idle sessions")
+
+
+@asynccontextmanager
+async def sessions_lifespan(app):
+    """
+    Router lifespan: open the session store (and import legacy sessions)
+    in a worker thread before serving, then archive idle sessions in the
+    background while the app runs.
+    """
+    await asyncio.to_thread(get_store)
+    task = asyncio.create_task(archive_sessions_periodically()) if SESSION_ARCHIVE_AFTER > 0 else None
+    yield
+    if task is not None:
+        task.cancel()
+
+
+router = APIRouter(lifespan=sessions_lifespan)
+
+
+def session_lock(session_id: str | None):
+    """
+    Serialize turns of one session within this worker, so a second message
+    sent before the first reply waits and then sees it in the history.
+    Other sessions are unaffected; across workers, appends are guarded by
+    the expected turn count instead (see record_turn).
+    """
+    if not session_id:
+        # A new session: nobody else can be using it yet
+        return nullcontext()
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    return lock
+
+
+def get_or_create_session(store, session_id=None, user_name=None):
+    """Return (session_id, history) of an existing session, otherwise create a new one."""
+    if session_id:
+        history = store.get(session_id)
+        if history is not None:
+            return session_id, history
     new_id = session_id or str(uuid.uuid4())
-    sessions[new_id] = []
-    return new_id
+    store.create(new_id, user_name)
+    return new_id, []
 
 def get_random_response(user_name: str) -> str:
     responses = [
@@ -51,13 +178,14 @@ def get_random_response(user_name: str) -> str:
     
     return random.choice(responses)
 
-def system_prompt(language: str, user_name: str, greeting_response:str | None = None) -> str:
-    return f"""
+# Static part of the system prompt. It must not interpolate anything so
+# that it stays byte-identical across turns and users and can be cached.
+STATIC_SYSTEM_PROMPT = """
 You are GpsLaw.AI — a legal guidance engine that behaves like a “GPS of the Law”.
 
-If user give you greetings respond exactly {greeting_response} 
+If user give you greetings respond exactly with the greeting given in the SESSION DETAILS below.
 
-If user want to know yourself or asked unrelated question, respond with user name {user_name} a short description about yourself.
+If user want to know yourself or asked unrelated question, respond with the user name from the SESSION DETAILS below and a short description about yourself.
 
 Your goal is to follow a strict sequence: LOCATE -> DIAGNOSE -> GUIDE -> ANTICIPATE.
 
@@ -68,19 +196,19 @@ Your goal is to follow a strict sequence: LOCATE -> DIAGNOSE -> GUIDE -> ANTICIP
    - Phase 2 (Diagnose): Ask 4-8 discriminating questions about the case (e.g., dates, contract types).
    - Phase 3 (Guide/Anticipate): Only provide the full structured guidance once Phase 1 and 2 are complete.
 3. OUTPUT FORMAT: You must ALWAYS respond in valid JSON.
-4. Before genrating legal guidance, you MUST ask 'Based on what you have shared, I can now give you comprehensive legal guidance. Would you like me to proceed?' something like that to confirm with user before giving legal guidance. If user says no, you should ask 'Is there any other information you would like to share or clarify?' and go back to Phase 2.
+4. Before genrating legal guidance, you MUST ask 'Based on what you have shared, I can now give you comprehensive legal guidance. Would you like me to proceed?' something like that to confirm with user before giving legal guidance, and set "awaiting_guidance_confirmation" to true in that response only. If user says no, you should ask 'Is there any other information you would like to share or clarify?' and go back to Phase 2.
 5. GUIDANCE LOCK: If you are still asking questions (Phase 1 or 2), the "legal_guidance" all object MUST be empty.
 
 ### RESPONSE JSON STRUCTURE:
-{{
+{
     "message": "<Your single question>",
-    "localization": {{
+    "localization": {
         "country": "<Country>",
         "legal_system": "<Legal System>",
         "jurisdiction": "<Jurisdiction>",
         "legal_domain": "<Legal Domain>"  
-    }},
-    "legal_guidance":{{
+    },
+    "legal_guidance":{
         "current_situation": "<A clear statement of who is legally favored>",
         "priority_action": "<One clear action the user should take immediately>",
         "what_to_avoid": [
@@ -88,14 +216,15 @@ Your goal is to follow a strict sequence: LOCATE -> DIAGNOSE -> GUIDE -> ANTICIP
             "<Common mistake 2>"
         ],
         "consequences_of_inaction": "<Brief explanation of likely consequences if no action is taken>",
-        "anticipation_projection": {{
+        "anticipation_projection": {
             "next_steps_if_action_fails": "<What happens if the priority action fails>",
             "typical_outcome": "<Typical outcome in similar cases>",
             "estimated_timeline": "<Estimated timeline if possible>"
-        }},
-    }}
+        },
+    }
     "legal_guidance_generation": <True/False> // True if legal_guidance is populated, False if still in questioning phase
-}}
+    "awaiting_guidance_confirmation": <True/False> // True only when the message asks the user to confirm they want the legal guidance
+}
 
 ### PHASE 1: LOCALIZATION (Mandatory)
 - If the user's location (Country/State) is unknown, ask: "Which country (and state/province if applicable) is this happening in?"
@@ -109,9 +238,145 @@ Your goal is to follow a strict sequence: LOCATE -> DIAGNOSE -> GUIDE -> ANTICIP
 - Only when you have enough info, populate the "legal_guidance" object using the 4 blocks and the Anticipation section.
 
 If user give you normal grettings or want to know yourself or asked unrelated question, respond with a short professional introduction about GpsLaw.AI 
-You should response based on the user selected language {language}.
+You should response based on the user selected language given in the SESSION DETAILS below.
 """
 
+
+def system_prompt(language: str, user_name: str, greeting_response:str | None = None) -> list[dict]:
+    """Cache-marked static prompt followed by the small per-session tail."""
+    session_details = f"""### SESSION DETAILS:
+- User name: {user_name}
+- Selected language: {language}
+- Greeting: {greeting_response or "N/A"}
+"""
+    return [
+        {"type": "text", "text": STATIC_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": session_details},
+    ]
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def history_window_start(history: list, token_budget: int, step: int) -> int:
+    """
+    Index of the first turn to send verbatim. Older turns are dropped in
+    multiples of `step` so the cut point (and with it the cached prefix)
+    only moves every few turns instead of on every turn. The cut is
+    rounded down: up to step - 1 turns over the budget are kept rather
+    than dropping recent turns that fit.
+    """
+    tokens = 0
+    start = len(history)
+    while start > 0:
+        m = history[start - 1]
+        tokens += estimate_tokens(m["user_message"]) + estimate_tokens(m["ai_message"])
+        if tokens > token_budget:
+            break
+        start -= 1
+    return start // step * step
+
+
+def condensed_history(dropped: list, token_budget: int) -> str:
+    """
+    The dropped Phase 1/2 turns in conversation order, each user message
+    followed by the reply to it; the newest are kept first if over budget.
+    """
+    lines = []
+    tokens = 0
+    for m in reversed(dropped):
+        line = f"- User: {m['user_message'][:200]}\n  AI: {m['ai_message'][:200]}"
+        tokens += estimate_tokens(line)
+        if tokens > token_budget:
+            break
+        lines.append(line)
+    lines.reverse()
+    return "Earlier in this conversation (condensed):\n" + "\n".join(lines)
+
+
+def case_state(history: list) -> str | None:
+    """Latest localization and legal guidance, which are always kept in context."""
+    localization = None
+    legal_guidance = None
+    for m in reversed(history):
+        if localization is None and m.get("localization"):
+            localization = m["localization"]
+        if legal_guidance is None and m.get("legal_guidance"):
+            legal_guidance = m["legal_guidance"]
+        if localization is not None and legal_guidance is not None:
+            break
+    if localization is None and legal_guidance is None:
+        return None
+    state = "Current case state:\n"
+    if localization is not None:
+        state += f"localization: {json.dumps(localization, ensure_ascii=False)}\n"
+    if legal_guidance is not None:
+        state += f"legal_guidance already given: {json.dumps(legal_guidance, ensure_ascii=False)}\n"
+    return state
+
+
+def build_messages(history: list, user_input: str) -> list[dict]:
+    """
+    Prior turns as alternating user/assistant messages. The last prior
+    message carries a cache breakpoint, so each turn reads the prefix
+    cached by the previous one and only the new messages are billed in full.
+
+    Only the most recent turns that fit HISTORY_TOKEN_BUDGET are sent
+    verbatim; older turns are condensed into a note on the first message.
+    The latest localization and legal guidance ride along with the new
+    user message, after the cached prefix. Blank stored messages are
+    replaced with EMPTY_TURN_TEXT, and turns that are blank on both sides
+    are skipped.
+    """
+    start = history_window_start(history, HISTORY_TOKEN_BUDGET, HISTORY_DROP_STEP)
+    messages = []
+    for m in history[start:]:
+        user_message, ai_message = m["user_message"], m["ai_message"]
+        if is_blank(user_message) and is_blank(ai_message):
+            continue
+        messages.append({"role": "user", "content": EMPTY_TURN_TEXT if is_blank(user_message) else user_message})
+        messages.append({"role": "assistant", "content": EMPTY_TURN_TEXT if is_blank(ai_message) else ai_message})
+    if messages:
+        messages[-1]["content"] = [
+            {"type": "text", "text": messages[-1]["content"], "cache_control": {"type": "ephemeral"}}
+        ]
+
+    current = [{"type": "text", "text": user_input}]
+    state = case_state(history)
+    if state:
+        current.insert(0, {"type": "text", "text": state})
+    messages.append({"role": "user", "content": current})
+
+    if start:
+        first = messages[0]
+        if isinstance(first["content"], str):
+            first["content"] = [{"type": "text", "text": first["content"]}]
+        first["content"].insert(
+            0, {"type": "text", "text": condensed_history(history[:start], HISTORY_SUMMARY_TOKEN_BUDGET)}
+        )
+    return messages
+
+
+def is_blank(text: str | None) -> bool:
+    return not text or text.isspace()
+
+
+def reply_text(message) -> str:
+    """The text of a reply; with web search it is preceded by tool blocks and may be split by citations."""
+    return "".join(block.text for block in message.content if block.type == "text")
+
+
+def log_usage(endpoint: str, usage) -> None:
+    metrics.record_usage(endpoint, usage)
+    print(
+        f"Token usage: input={usage.input_tokens} "
+        f"cache_read={usage.cache_read_input_tokens or 0} "
+        f"cache_creation={usage.cache_creation_input_tokens or 0} "
+        f"output={usage.output_tokens}"
+    )
+
 TEXT_FORMAT = {
     "type": "json_schema",
     "schema": {
@@ -174,101 +439,398 @@ TEXT_FORMAT = {
             "legal_guidance_generation": {
                 "type": "boolean",
                 "description": "False while asking questions, True when legal_guidance is populated"
+            },
+            "awaiting_guidance_confirmation": {
+                "type": "boolean",
+                "description": "True only when the message asks the user to confirm they want the legal guidance"
             }
         },
         "required": [
             "message",
             "localization",
             "legal_guidance",
-            "legal_guidance_generation"
+            "legal_guidance_generation",
+            "awaiting_guidance_confirmation"
         ],
         "additionalProperties": False
     }
     # "strict": True
 }
 
+ChatReply = response_model("ChatReply", TEXT_FORMAT)
+
+
+SESSION_CONFLICT_DETAIL = "The session was updated by another request. Please resend your message."
+
+
 class ChatRequest(BaseModel):
     session_id: str | None = None
-    user_input: str
+    user_input: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
     language: str | None = "english"
     user_name: str 
 
 
-@app.post("/chat")
-def chat(request: ChatRequest):
-    start_time = time()
-    sessions = load_sessions()
-
-    session_id = get_or_create_session(sessions, request.session_id)
+async def prepare_turn(request: ChatRequest, endpoint: str):
+    """
+    Load (or create) the session and either answer the turn on the fast
+    path or build the model request for it. Returns (session_id, params,
+    turns, reply), with params None when `reply` is the fast-path answer.
+    """
+    with metrics.span(endpoint, "session_load"):
+        # Session I/O, and opening the store if the lifespan has not, is
+        # blocking sqlite work: keep it off the event loop
+        session_id, history = await asyncio.to_thread(
+            lambda: get_or_create_session(get_store(), request.session_id, request.user_name)
+        )
     
+    reply = fast_path_reply(request, len(history), endpoint)
+    if reply is not None:
+        return session_id, None, len(history), reply
+
+    gretting_response = None
     if not request.session_id:
         gretting_response = get_random_response(request.user_name)
         
-    print(f"Greeting response: {gretting_response if not request.session_id else 'N/A'}")
-
-    conversation_text = ""
-    for m in sessions[session_id]:
-        conversation_text += f"User: {m['user_message']}\nAI: {m['ai_message']}\n"
-    conversation_text += f"User: {request.user_input}\nAI:"
-
-    try:
-        
-        response = client.messages.create(
-            model="claude-sonnet-4-5", 
-            max_tokens=8192,
-            system=system_prompt(request.language, request.user_name, gretting_response if not request.session_id else None),
-            messages=[
-                {"role": "user", "content": conversation_text}
-            ],
+    print(f"Greeting response: {gretting_response or 'N/A'}")
+
+    system = system_prompt(request.language, request.user_name, gretting_response)
+    phase = chat_phase(history)
+    route = GUIDANCE_ROUTE if phase in ("guide", "follow_up") else QUESTION_ROUTE
+    context = None
+    if route is GUIDANCE_ROUTE:
+        context = await cached_legal_context(history, endpoint)
+        if context is not None:
+            system.append({"type": "text", "text": context})
+    log_route(endpoint, phase, route, cached_search=context is not None)
+
+    with metrics.span(endpoint, "prompt_build"):
+        params = dict(
+            **route,
+            system=system,
+            messages=build_messages(history, request.user_input),
             output_config={
                 "format": TEXT_FORMAT
-            },
-            tools=[{"type": "web_search_20260209", "name": "web_search"}]
+            }
         )
+    return session_id, params, len(history), None
+
+
+def chat_phase(history: list) -> str:
+    """
+    Where the conversation stands, from the stored turns: "locate" (no
+    country yet), "diagnose" (asking case questions), "guide" (the last
+    reply asked to confirm the guidance) or "follow_up" (guidance given).
+    """
+    if any(m.get("legal_guidance") for m in history):
+        return "follow_up"
+    if history and history[-1].get("awaiting_guidance_confirmation"):
+        return "guide"
+    return "diagnose" if (latest_localization(history) or {}).get("country") else "locate"
+
+
+def latest_localization(history: list) -> dict | None:
+    for m in reversed(history):
+        if m.get("localization"):
+            return m["localization"]
+    return None
+
+
+async def cached_legal_context(history: list, endpoint: str) -> str | None:
+    """Prompt block of cached searches for the session's jurisdiction, if there are enough of them."""
+    if not SEARCH_CACHE_ENABLED:
+        return None
+    key = legal_context.jurisdiction_key(latest_localization(history))
+    if key is None:
+        return None
+    with metrics.span(endpoint, "search_cache"):
+        searches = await asyncio.to_thread(content_cache.get_search_cache().get, key)
+    context = None
+    if sum(len(results) for _, results in searches) >= SEARCH_CONTEXT_MIN_RESULTS:
+        context = legal_context.context_block(searches, SEARCH_CONTEXT_MAX_CHARS)
+    SEARCH_CACHE_LOOKUPS.inc(result="miss" if context is None else "hit")
+    return context
+
+
+async def remember_searches(message, localization: dict | None, endpoint: str) -> None:
+    """Store the web searches made for a reply under its jurisdiction."""
+    if not SEARCH_CACHE_ENABLED:
+        return
+    key = legal_context.jurisdiction_key(localization)
+    searches = legal_context.extract_searches(message) if key else []
+    if searches:
+        with metrics.span(endpoint, "search_cache"):
+            await asyncio.to_thread(content_cache.get_search_cache().put, key, searches)
+
+
+def log_route(endpoint: str, phase: str, route: dict, cached_search: bool = False) -> None:
+    CHAT_ROUTES.inc(endpoint=endpoint, phase=phase, model=route["model"])
+    print(
+        f"Chat route: phase={phase} model={route['model']} max_tokens={route['max_tokens']} "
+        f"web_search={'tools' in route} cached_search={cached_search}"
+    )
+
+
+def escalation_reason(params: dict, stop_reason: str | None, text: str) -> str | None:
+    """
+    Why a questioning-route reply has to be redone on the guidance route:
+    it ran out of tokens, is not valid for the output format, or the model
+    started giving guidance without the confirmation turn. None if it is fine.
+    """
+    if params["model"] == GUIDANCE_ROUTE["model"] and params["max_tokens"] == GUIDANCE_ROUTE["max_tokens"]:
+        # Already on the guidance route
+        return None
+    if stop_reason == "max_tokens":
+        return "max_tokens"
+    try:
+        reply = decode_response(text, ChatReply)
+    except ResponseDecodeError:
+        return "invalid_reply"
+    if reply.get("legal_guidance_generation"):
+        return "guidance"
+    return None
+
+
+def escalate(params: dict, endpoint: str, reason: str) -> dict:
+    """The same request on the guidance route."""
+    log_route(endpoint, f"escalated:{reason}", GUIDANCE_ROUTE)
+    return {**params, **GUIDANCE_ROUTE}
+
+
+def fast_path_reply(request: ChatRequest, turns: int, endpoint: str) -> str | None:
+    """Canned reply when a new session opens with small talk, otherwise None."""
+    if not FAST_PATH_ENABLED or turns:
+        return None
+    intent = small_talk.classify(request.user_input)
+    if intent is None:
+        return None
+    reply = small_talk.reply(intent, request.language, request.user_name, get_random_response(request.user_name))
+    if reply is not None:
+        FAST_PATH_REPLIES.inc(endpoint=endpoint, intent=intent)
+    return reply
+
+
+async def record_turn(session_id: str, expected_turns: int, user_input: str, response_json: dict, endpoint: str) -> dict:
+    """
+    Persist the completed turn and return the /chat response body. Raises
+    SessionConflict if the session gained turns since prepare_turn read it.
+    """
+    ai_message = response_json.get("message", "")
+    legal_guidance = response_json.get("legal_guidance", {})
+    localization = response_json.get("localization", {})
+    legal_guidance_generation = response_json.get("legal_guidance_generation", False)
+    
+    conversation_entry = {
+        "user_message": user_input,
+        "ai_message": ai_message,
+    }
+    
+    if legal_guidance:
+        conversation_entry["legal_guidance"] = legal_guidance
+    if localization:
+        conversation_entry["localization"] = localization
+    if response_json.get("awaiting_guidance_confirmation"):
+        # Routes the user's answer to the guidance model (see chat_phase)
+        conversation_entry["awaiting_guidance_confirmation"] = True
+
+    # check the legal_guidance_generation flag. based on that, we can decide whether full guidance is generate or not 
+    
+    with metrics.span(endpoint, "session_save"):
+        await asyncio.to_thread(lambda: get_store().append(session_id, conversation_entry, expected_turns))
+
+    return {
+        "session_id": session_id,
+        "response": {
+            "message": ai_message,
+            "localization": localization,
+            "legal_guidance": legal_guidance,
+            "legal_guidance_generation": legal_guidance_generation
+        }
+    }
 
-        end_time = time()
-        print(f"Response time: {end_time - start_time:.2f} seconds")
-        print(response.content[0].text)
 
-        ai_reply = response.content[0].text
+async def create_message(params: dict):
+    """One /chat model call, once admitted."""
+    async with admission.admit("/chat", params) as ticket:
+        response = await clients.get_unretried_client().messages.create(**params)
+    admission.settle(ticket, response.usage)
+    return response
 
-        # Remove markdown code blocks if present
-        ai_reply = re.sub(r'^```json\s*', '', ai_reply)
-        ai_reply = re.sub(r'^```\s*', '', ai_reply)
-        ai_reply = re.sub(r'\s*```$', '', ai_reply)
-        ai_reply = ai_reply.strip()
-        
-        response_json = json.loads(ai_reply)
-        ai_message = response_json.get("message", "")
-        legal_guidance = response_json.get("legal_guidance", {})
-        localization = response_json.get("localization", {})
-        legal_guidance_generation = response_json.get("legal_guidance_generation", False)
-        
-        conversation_entry = {
-            "user_message": request.user_input,
-            "ai_message": ai_message,
-        }
-        
-        if legal_guidance:
-            conversation_entry["legal_guidance"] = legal_guidance
-        if localization:
-            conversation_entry["localization"] = localization
 
-        # check the legal_guidance_generation flag. based on that, we can decide whether full guidance is generate or not 
-        
-        sessions[session_id].append(conversation_entry)
-        save_sessions(sessions)
-
-        return {
-            "session_id": session_id,
-            "response": {
-                "message": ai_message,
-                "localization": localization,
-                "legal_guidance": legal_guidance,
-                "legal_guidance_generation": legal_guidance_generation
-            }
-        }
+@router.post("/chat")
+async def chat(request: ChatRequest):
+    start_time = time()
 
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail=str(e))
+    async with session_lock(request.session_id):
+        session_id, params, turns, reply = await prepare_turn(request, "/chat")
+
+        try:
+            if reply is not None:
+                return await record_turn(session_id, turns, request.user_input, {"message": reply}, "/chat")
+            
+            while True:
+                with metrics.span("/chat", "model_call"):
+                    response = await resilience.call(lambda: create_message(params), "/chat")
+                log_usage("/chat", response.usage)
+
+                reason = escalation_reason(params, response.stop_reason, reply_text(response))
+                if reason is None:
+                    break
+                params = escalate(params, "/chat", reason)
+
+            end_time = time()
+            print(f"Response time: {end_time - start_time:.2f} seconds")
+
+            with metrics.span("/chat", "decode"):
+                response_json = decode_response(reply_text(response), ChatReply)
+            await remember_searches(response, response_json.get("localization"), "/chat")
+
+            return await record_turn(session_id, turns, request.user_input, response_json, "/chat")
+
+        except session_store.SessionConflict as e:
+            print(e)
+            raise HTTPException(status_code=409, detail=SESSION_CONFLICT_DETAIL)
+        except Exception as e:
+            print(e)
+            raise HTTPException(status_code=resilience.error_status(e), detail=str(e))
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Streaming variant of /chat as server-sent events: `session`, then
+    `message` deltas plus `localization` / `legal_guidance` as soon as they
+    are complete, then `done` with the same body /chat returns. A `reset`
+    event means the reply is being regenerated by the guidance model and
+    everything received since `session` should be discarded. The turn is
+    persisted only once the stream has completed; turns of one session
+    are streamed one at a time.
+    """
+    start_time = time()
+    client = clients.get_async_client()
+
+    async def events():
+        async with session_lock(request.session_id):
+            try:
+                session_id, params, turns, reply = await prepare_turn(request, "/chat/stream")
+                yield sse_event("session", {"session_id": session_id})
+
+                if reply is not None:
+                    yield sse_event("message", {"delta": reply})
+                    yield sse_event("done", await record_turn(session_id, turns, request.user_input, {"message": reply}, "/chat/stream"))
+                    return
+
+                while True:
+                    parser = PartialReplyParser()
+                    model_start = time()
+                    first_token = True
+                    with metrics.span("/chat/stream", "model_call"):
+                        async with admission.admit("/chat/stream", params) as ticket:
+                            async with client.messages.stream(**params) as stream:
+                                async for event in stream:
+                                    if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                                        if first_token:
+                                            metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(time() - model_start, endpoint="/chat/stream")
+                                            first_token = False
+                                        for name, data in parser.feed(event.delta.text):
+                                            yield sse_event(name, data)
+                                final_message = await stream.get_final_message()
+                    admission.settle(ticket, final_message.usage)
+                    log_usage("/chat/stream", final_message.usage)
+
+                    reason = escalation_reason(params, final_message.stop_reason, parser.text)
+                    if reason is None:
+                        break
+                    yield sse_event("reset", {"reason": reason})
+                    params = escalate(params, "/chat/stream", reason)
+
+                print(f"Response time: {time() - start_time:.2f} seconds")
+
+                with metrics.span("/chat/stream", "decode"):
+                    response_json = decode_response(parser.text, ChatReply)
+                await remember_searches(final_message, response_json.get("localization"), "/chat/stream")
+                yield sse_event("done", await record_turn(session_id, turns, request.user_input, response_json, "/chat/stream"))
+
+            except session_store.SessionConflict as e:
+                print(e)
+                yield sse_event("error", {"detail": SESSION_CONFLICT_DETAIL, "status_code": 409})
+            except Exception as e:
+                print(e)
+                yield sse_event("error", {"detail": str(e), "status_code": resilience.error_status(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def iso_time(timestamp: float | None) -> str | None:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else None
+
+
+@router.get("/sessions")
+def list_sessions(
+    user_name: str | None = None,
+    country: str | None = None,
+    legal_domain: str | None = None,
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: str | None = None,
+):
+    """
+    Sessions, most recently active first, optionally filtered by user name
+    and by the country / legal domain of their latest localization, which
+    match on leading words ignoring case, accents and punctuation
+    (legal_domain=employment finds "Employment law (Droit du travail)").
+    Pass `next_cursor` back as `cursor` for the next page.
+    """
+    try:
+        sessions, next_cursor = get_store().list_sessions(user_name, country, legal_domain, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for session in sessions:
+        session["created_at"] = iso_time(session["created_at"])
+        session["updated_at"] = iso_time(session["updated_at"])
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+
+@router.get("/sessions/{session_id}/turns")
+def get_session_turns(
+    session_id: str,
+    cursor: int = Query(default=0, ge=0),
+    limit: int = Query(default=20, ge=1, le=200),
+):
+    """Turns of one session from position `cursor` (0 is the first turn); `next_cursor` is null on the last page."""
+    page = get_store().get_turns(session_id, cursor, limit)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    turns, next_cursor = page
+    return {"session_id": session_id, "turns": turns, "next_cursor": next_cursor}
+
+
+@router.get("/chat/session_cache")
+def session_cache_stats():
+    """Hit/miss/eviction counters of the in-memory session cache."""
+    return get_store().stats()
+
+
+def session_cache_metrics() -> list[str]:
+    if _store is None:
+        return []
+    lines = ["# TYPE gpslaw_session_cache gauge"]
+    for name, value in _store.stats().items():
+        lines.append(f'gpslaw_session_cache{{stat="{name}"}} {value}')
+    return lines
+
+
+metrics.register_collector(session_cache_metrics)
+
+
+# Standalone app, kept for deployments that still run `uvicorn ai_chat:app`
+app = FastAPI(title="GpsLaw.AI Chat API", lifespan=clients.lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(router)
+app.include_router(metrics.router)
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of structured-reply decoding on large model outputs.
+
+Compares the shared response_decoder (single-pass fence strip plus
+pydantic/jiter validation) with the previous per-endpoint code (three
+re.sub fence strips plus json.loads) and the old greedy `\\{.*\\}` DOTALL
+extract_json helper, on OCR and document-analysis replies of several
+sizes, with and without a ```json fence.
+
+    python benchmarks/decoder.py [--sizes 10,100,500] [--repeat 50]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from doc_ai_analysis import DocAnalysisReply
+from ocr import OcrReply
+from response_decoder import decode_response
+
+
+def old_decode(ai_reply: str) -> dict:
+    ai_reply = re.sub(r'^```json\s*', '', ai_reply)
+    ai_reply = re.sub(r'^```\s*', '', ai_reply)
+    ai_reply = re.sub(r'\s*```$', '', ai_reply)
+    return json.loads(ai_reply.strip())
+
+
+def old_extract_json(text: str):
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    return json.loads(match.group(0)) if match else None
+
+
+def ocr_reply(size_kb: int) -> str:
+    line = "Article 12 — Le salarié perçoit une rémunération brute mensuelle de 3 200 €.\n"
+    data = line * (size_kb * 1024 // len(line.encode()) + 1)
+    return json.dumps({"success": True, "data": data}, ensure_ascii=False)
+
+
+def doc_reply(size_kb: int) -> str:
+    item = "Clause 7.2 allows the employer to terminate for convenience with 8 days notice."
+    count = size_kb * 1024 // (3 * len(item)) + 1
+    return json.dumps({
+        "localization": {"country": "France", "legal_system": "Civil Law",
+                         "jurisdiction": "France", "legal_domain": "Employment Law"},
+        "potential_risks": [item] * count,
+        "key_clauses": [item] * count,
+        "ai_recommendation": [item] * count,
+        "summary": item,
+    })
+
+
+def timed(fn, text: str, repeat: int) -> float:
+    fn(text)
+    start = perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,500", help="reply sizes in KB")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'reply':24} {'old re+json':>12} {'extract_json':>13} {'decoder':>10}   (ms per reply)")
+    for size_kb in (int(size) for size in args.sizes.split(",")):
+        for name, make, model in (("ocr", ocr_reply, OcrReply), ("doc_analysis", doc_reply, DocAnalysisReply)):
+            for fenced in (False, True):
+                text = make(size_kb)
+                if fenced:
+                    text = f"```json\n{text}\n```"
+                assert decode_response(text, model) == old_decode(text)
+                label = f"{name} {size_kb}KB{' fenced' if fenced else ''}"
+                print(f"{label:24} "
+                      f"{timed(old_decode, text, args.repeat):12.3f} "
+                      f"{timed(old_extract_json, text, args.repeat):13.3f} "
+                      f"{timed(lambda t: decode_response(t, model), text, args.repeat):10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Offline load test of the gateway against the local mock model server.
+
+Starts benchmarks/mock_anthropic.py and the gateway under uvicorn (the
+gateway's client is pointed at the mock through ANTHROPIC_BASE_URL, so no
+API key or network access is needed), then drives each endpoint at
+increasing concurrency. For every level it reports requests per second,
+p50/p95/p99 latency, errors and the resident memory of each gateway worker.
+
+Chat traffic replays the conversations in chat_sessions.json turn by
+turn, each virtual user on its own session. OCR, document analysis and
+the extract-then-analyze pipeline use a new file_id per request so
+results are not served from the result cache.
+
+    python benchmarks/load_test.py [--endpoints chat,chat_stream,upload,ocr,doc,pipeline]
+        [--concurrency 1,8,32,64] [--duration 10] [--workers 1]
+        [--latency 0.5] [--reply-kb 2] [--stream-chunks 20] [--upload-kb 256]
+        [--sessions-file chat_sessions.json] [--json results.json]
+
+Pass --url to load an already running gateway instead (worker memory is
+then not reported). Worker memory is read from /proc and needs Linux.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import uuid
+from time import perf_counter, sleep
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(ROOT, "benchmarks")
+
+ENDPOINTS = ("chat", "chat_stream", "upload", "ocr", "doc", "pipeline")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app_dir: str, app: str, port: int, env: dict, cwd: str, workers: int = 1) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", app_dir, app,
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        env={**os.environ, **env}, cwd=cwd, stdout=subprocess.DEVNULL,
+    )
+    deadline = perf_counter() + 60
+    while perf_counter() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"{app} exited with status {proc.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/openapi.json", timeout=1).raise_for_status()
+            return proc
+        except httpx.HTTPError:
+            sleep(0.2)
+    proc.terminate()
+    sys.exit(f"{app} did not start within 60 s")
+
+
+def worker_pids(pid: int) -> list[int]:
+    """The uvicorn worker processes under `pid`, or `pid` itself when it serves directly."""
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    workers = []
+    for child in children:
+        # Skip multiprocessing's resource tracker, which uvicorn also starts
+        with open(f"/proc/{child}/cmdline", "rb") as f:
+            if b"resource_tracker" not in f.read():
+                workers.append(child)
+    return workers or [pid]
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def load_conversations(path: str) -> list[list[str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        sessions = json.load(f)
+    conversations = [
+        [turn["user_message"] for turn in turns if turn.get("user_message")]
+        for turns in sessions.values()
+    ]
+    return [conversation for conversation in conversations if conversation]
+
+
+class Scenario:
+    """Issues one endpoint's requests; `run_user` loops until `deadline`, recording each latency."""
+
+    def __init__(self, name: str, args, conversations: list[list[str]]):
+        self.name = name
+        self.args = args
+        self.conversations = itertools.cycle(conversations)
+        self.counter = itertools.count()
+        self.ttft = []
+
+    async def request(self, client: httpx.AsyncClient) -> bool:
+        n = next(self.counter)
+        if self.name == "upload":
+            # Distinct content per request so none is deduplicated by hash
+            content = b"%d " % n * (self.args.upload_kb * 1024 // (len(str(n)) + 1))
+            response = await client.post(
+                "/upload_file", files={"file": (f"contract-{n}.pdf", content, "application/pdf")}
+            )
+        else:
+            path = {"ocr": "/extract_user_details", "doc": "/doc_analysis",
+                    "pipeline": "/extract_and_analyze"}[self.name]
+            response = await client.post(
+                path, params={"file_id": f"file_load_{uuid.uuid4().hex}", "mime_type": "application/pdf"}
+            )
+        return response.status_code == 200
+
+    async def chat_turn(self, client: httpx.AsyncClient, session_id: str, user_input: str) -> bool:
+        body = {"session_id": session_id, "user_input": user_input,
+                "language": "english", "user_name": "Load Test"}
+        if self.name == "chat":
+            response = await client.post("/chat", json=body)
+            return response.status_code == 200
+
+        start = perf_counter()
+        ok = False
+        async with client.stream("POST", "/chat/stream", json=body) as response:
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "message" and start is not None:
+                        self.ttft.append(perf_counter() - start)
+                        start = None
+                    ok = ok or event == "done"
+                    if event == "error":
+                        return False
+        return response.status_code == 200 and ok
+
+    async def run_user(self, client: httpx.AsyncClient, deadline: float, latencies: list, errors: list):
+        while perf_counter() < deadline:
+            if self.name in ("chat", "chat_stream"):
+                session_id = str(uuid.uuid4())
+                for user_input in next(self.conversations):
+                    if perf_counter() >= deadline:
+                        return
+                    await self.timed(self.chat_turn(client, session_id, user_input), latencies, errors)
+            else:
+                await self.timed(self.request(client), latencies, errors)
+
+    @staticmethod
+    async def timed(call, latencies: list, errors: list):
+        start = perf_counter()
+        try:
+            ok = await call
+        except httpx.HTTPError:
+            ok = False
+        latencies.append(perf_counter() - start)
+        if not ok:
+            errors.append(1)
+
+
+async def run_level(base_url: str, scenario: Scenario, concurrency: int, duration: float) -> dict:
+    latencies, errors = [], []
+    scenario.ttft = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        start = perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(
+            scenario.run_user(client, deadline, latencies, errors) for _ in range(concurrency)
+        ))
+        elapsed = perf_counter() - start
+    latencies.sort()
+    ttft = sorted(scenario.ttft)
+    return {
+        "endpoint": scenario.name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "ttft_p50_ms": percentile(ttft, 50) * 1000 if ttft else None,
+    }
+
+
+def print_row(result: dict):
+    memory = " ".join(f"{mb:.0f}" for mb in result.get("worker_rss_mb", [])) or "-"
+    ttft = f"{result['ttft_p50_ms']:8.0f}" if result["ttft_p50_ms"] is not None else f"{'-':>8}"
+    print(f"{result['endpoint']:12} {result['concurrency']:5} {result['requests']:8} {result['errors']:6} "
+          f"{result['rps']:8.1f} {result['p50_ms']:8.0f} {result['p95_ms']:8.0f} {result['p99_ms']:8.0f} "
+          f"{ttft}  {memory}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,8,32,64")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--workers", type=int, default=1, help="gateway uvicorn workers")
+    parser.add_argument("--latency", type=float, default=0.5, help="mock model latency in seconds")
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--reply-kb", type=float, default=2)
+    parser.add_argument("--upload-latency", type=float, default=0.2)
+    parser.add_argument("--upload-kb", type=int, default=256)
+    parser.add_argument("--sessions-file", default=os.path.join(ROOT, "chat_sessions.json"))
+    parser.add_argument("--url", help="load an already running gateway instead of starting one")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    endpoints = args.endpoints.split(",")
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    conversations = load_conversations(args.sessions_file)
+
+    servers = []
+    with tempfile.TemporaryDirectory() as cwd:
+        try:
+            gateway_pid = None
+            base_url = args.url
+            if base_url is None:
+                mock_port = free_port()
+                servers.append(start_server(BENCHMARKS, "mock_anthropic:app", mock_port, {
+                    "MOCK_LATENCY": str(args.latency),
+                    "MOCK_CHUNK_DELAY": str(args.chunk_delay),
+                    "MOCK_STREAM_CHUNKS": str(args.stream_chunks),
+                    "MOCK_REPLY_KB": str(args.reply_kb),
+                    "MOCK_UPLOAD_LATENCY": str(args.upload_latency),
+                }, cwd))
+                gateway_port = free_port()
+                # Runs in an empty directory: no .env, fresh session and content-cache databases
+                gateway = start_server(ROOT, "gateway:app", gateway_port, {
+                    "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{mock_port}",
+                    "ANTHROPIC_API_KEY": "mock",
+                }, cwd, workers=args.workers)
+                servers.append(gateway)
+                gateway_pid = gateway.pid
+                base_url = f"http://127.0.0.1:{gateway_port}"
+
+            print(f"{'endpoint':12} {'conc':>5} {'requests':>8} {'errors':>6} {'rps':>8} "
+                  f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttft p50':>8}  worker RSS MB")
+            results = []
+            for name in endpoints:
+                scenario = Scenario(name, args, conversations)
+                for concurrency in (int(c) for c in args.concurrency.split(",")):
+                    result = asyncio.run(run_level(base_url, scenario, concurrency, args.duration))
+                    if gateway_pid is not None:
+                        result["worker_rss_mb"] = [rss_mb(pid) for pid in worker_pids(gateway_pid)]
+                    print_row(result)
+                    results.append(result)
+        finally:
+            for proc in reversed(servers):
+                proc.terminate()
+                proc.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
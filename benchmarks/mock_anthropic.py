@@ -0,0 +1,141 @@
+"""
+Local stand-in for the Anthropic Messages and Files APIs, for load tests
+that must not spend real tokens.
+
+Replies are generated from the request's json_schema output format, so
+/chat, /extract_user_details and /doc_analysis all get a reply they can
+decode. Latency, streaming and payload size are set through environment
+variables:
+
+    MOCK_LATENCY         seconds before the reply (or first streamed chunk), default 0.5
+    MOCK_CHUNK_DELAY     seconds between streamed chunks, default 0.02
+    MOCK_STREAM_CHUNKS   number of text deltas in a streamed reply, default 20
+    MOCK_REPLY_KB        approximate size of each reply, default 2
+    MOCK_UPLOAD_LATENCY  seconds to accept a Files API upload, default 0.2
+
+Run it on its own and point the app at it with ANTHROPIC_BASE_URL:
+
+    uvicorn benchmarks.mock_anthropic:app --port 8900
+"""
+import asyncio
+import json
+import os
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+LATENCY = float(os.environ.get("MOCK_LATENCY") or 0.5)
+CHUNK_DELAY = float(os.environ.get("MOCK_CHUNK_DELAY") or 0.02)
+STREAM_CHUNKS = int(os.environ.get("MOCK_STREAM_CHUNKS") or 20)
+REPLY_KB = float(os.environ.get("MOCK_REPLY_KB") or 2)
+UPLOAD_LATENCY = float(os.environ.get("MOCK_UPLOAD_LATENCY") or 0.2)
+
+FILLER = "Under the applicable labour code the employer must pay all sums due on termination. "
+
+app = FastAPI(title="Mock Anthropic API")
+
+
+def sample_value(schema: dict, filler: str):
+    """A value matching `schema`; every string gets `filler`."""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: sample_value(sub, filler) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_value(schema.get("items", {}), filler)]
+    if kind == "boolean":
+        return True
+    if kind in ("integer", "number"):
+        return 1
+    return filler
+
+
+def reply_text(body: dict) -> str:
+    schema = ((body.get("output_config") or {}).get("format") or {}).get("schema")
+    if schema is None:
+        return FILLER
+    # Size the reply by the number of string fields so the total is ~REPLY_KB
+    strings = json.dumps(sample_value(schema, "")).count('""') or 1
+    filler = FILLER * max(1, int(REPLY_KB * 1024 / strings / len(FILLER)))
+    reply = sample_value(schema, filler.strip())
+    if "legal_guidance" in reply:
+        # /chat: questioning turns (no tools) leave the guidance empty, as the real model must
+        reply["awaiting_guidance_confirmation"] = False
+        if not body.get("tools"):
+            reply["legal_guidance"] = {}
+            reply["legal_guidance_generation"] = False
+    return json.dumps(reply)
+
+
+def usage(body: dict, text: str) -> dict:
+    prompt = len(json.dumps(body.get("system", ""))) + len(json.dumps(body.get("messages", [])))
+    return {
+        "input_tokens": prompt // 4,
+        "output_tokens": len(text) // 4,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+    }
+
+
+def message(body: dict, text: str) -> dict:
+    return {
+        "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "mock"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": usage(body, text),
+    }
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(body: dict, text: str):
+    start = message(body, "")
+    start["content"] = []
+    start["stop_reason"] = None
+    yield sse("message_start", {"type": "message_start", "message": start})
+    yield sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+    step = max(1, -(-len(text) // STREAM_CHUNKS))
+    for offset in range(0, len(text), step):
+        if offset:
+            await asyncio.sleep(CHUNK_DELAY)
+        yield sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": text[offset:offset + step]}})
+    yield sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+    yield sse("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": usage(body, text)})
+    yield sse("message_stop", {"type": "message_stop"})
+
+
+@app.post("/v1/messages")
+async def create_message(request: Request):
+    body = await request.json()
+    text = reply_text(body)
+    await asyncio.sleep(LATENCY)
+    if body.get("stream"):
+        return StreamingResponse(stream_events(body, text), media_type="text/event-stream")
+    return message(body, text)
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    form = await request.form()
+    upload = form["file"]
+    size = len(await upload.read())
+    await asyncio.sleep(UPLOAD_LATENCY)
+    return {
+        "id": f"file_mock_{uuid.uuid4().hex[:24]}",
+        "type": "file",
+        "filename": upload.filename,
+        "mime_type": upload.content_type or "application/octet-stream",
+        "size_bytes": size,
+        "created_at": "2026-01-01T00:00:00Z",
+        "downloadable": False,
+    }
@@ -0,0 +1,120 @@
+"""
+Regression benchmark: N parallel requests to the async file endpoints must
+finish in roughly the time of one, i.e. no endpoint blocks the event loop
+while waiting on the upstream API.
+
+The upstream client is replaced by a fake that sleeps for --latency seconds
+without blocking, so no API key or network access is needed.
+
+    python benchmarks/parallel_endpoints.py [-n 8] [--latency 0.5] [--max-ratio 2.0]
+
+Exits non-zero if N parallel requests take more than --max-ratio times a
+single request on any endpoint.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+import clients
+import content_cache
+import doc_ai_analysis
+import file_upload
+import ocr
+
+OCR_REPLY = json.dumps({"success": True, "data": "Lorem ipsum"})
+DOC_REPLY = json.dumps({
+    "localization": {"country": "France", "legal_system": "Civil Law",
+                     "jurisdiction": "France", "legal_domain": "Employment Law"},
+    "potential_risks": [], "key_clauses": [], "ai_recommendation": [], "summary": "",
+})
+
+
+class FakeClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.beta = SimpleNamespace(
+            messages=SimpleNamespace(create=self.create),
+            files=SimpleNamespace(upload=self.upload),
+        )
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        reply = OCR_REPLY if kwargs["output_config"]["format"] is ocr.OCR_TEXT_FORMAT else DOC_REPLY
+        usage = SimpleNamespace(input_tokens=1000, output_tokens=100,
+                                cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=reply)],
+                               usage=usage, stop_reason="end_turn")
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def upload(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(id="file_bench")
+
+
+def make_request(module):
+    # Every request uses distinct content so none is served from the result cache
+    counter = itertools.count()
+    if module is file_upload:
+        return lambda c: c.post(
+            "/upload_file",
+            files={"file": ("contract.txt", b"%d" % next(counter) * 1024, "text/plain")},
+        )
+    path = "/extract_user_details" if module is ocr else "/doc_analysis"
+    return lambda c: c.post(
+        path, params={"file_id": f"file_bench_{next(counter)}", "mime_type": "application/pdf"}
+    )
+
+
+async def timed(module, request, n: int) -> float:
+    transport = httpx.ASGITransport(app=module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        start = perf_counter()
+        responses = await asyncio.gather(*(request(c) for _ in range(n)))
+        elapsed = perf_counter() - start
+    failed = [r.status_code for r in responses if r.status_code != 200]
+    if failed:
+        raise SystemExit(f"{module.__name__}: requests failed with {failed}")
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--max-ratio", type=float, default=2.0)
+    args = parser.parse_args()
+
+    content_cache._db = content_cache.SqliteDatabase(
+        os.path.join(tempfile.mkdtemp(), content_cache.CONTENT_CACHE_DB)
+    )
+    clients._async_client = FakeClient(args.latency)
+
+    ok = True
+    for module in (ocr, doc_ai_analysis, file_upload):
+        request = make_request(module)
+        single = await timed(module, request, 1)
+        parallel = await timed(module, request, args.n)
+        ratio = parallel / single
+        status = "ok" if ratio <= args.max_ratio else "FAIL"
+        ok = ok and ratio <= args.max_ratio
+        print(f"{module.__name__:16} 1 request: {single:.2f}s  "
+              f"{args.n} parallel: {parallel:.2f}s  ratio {ratio:.2f}  {status}")
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
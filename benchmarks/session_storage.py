@@ -0,0 +1,82 @@
+"""
+Storage size and load time of chat sessions in each format: the legacy
+pretty-printed chat_sessions.json (parsed whole on every request), the
+SQLite turn rows (compact JSON, unchanged localizations elided) and the
+zlib-compressed cold archive.
+
+The sessions in chat_sessions.json are copied --copies times under new
+ids to get a realistic store size.
+
+    python benchmarks/session_storage.py [--copies 20] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import session_store
+
+
+def load_ms(fn, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200, help="session loads timed per format")
+    parser.add_argument("--sessions-file", default=os.path.join(ROOT, "chat_sessions.json"))
+    args = parser.parse_args()
+
+    with open(args.sessions_file, "r", encoding="utf-8") as f:
+        original = json.load(f)
+    sessions = {
+        f"{session_id}-{copy}": turns
+        for copy in range(args.copies)
+        for session_id, turns in original.items()
+    }
+    ids = list(sessions)
+    turns = sum(len(entries) for entries in sessions.values())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "chat_sessions.json")
+        with open(json_path, "w") as f:
+            json.dump(sessions, f, indent=2)
+
+        def load_json():
+            with open(json_path, "r") as f:
+                return json.load(f)[random.choice(ids)]
+
+        store = session_store.SqliteSessionStore(os.path.join(tmp, "chat_sessions.db"))
+        for session_id, entries in sessions.items():
+            store.import_session(session_id, entries)
+        conn = sqlite3.connect(os.path.join(tmp, "chat_sessions.db"))
+        (hot_bytes,) = conn.execute("SELECT SUM(LENGTH(data)) FROM turns").fetchone()
+        hot_ms = load_ms(lambda: store.get(random.choice(ids)), args.repeat)
+
+        store.archive_idle(0)
+        (cold_bytes,) = conn.execute("SELECT SUM(LENGTH(data)) FROM archived_sessions").fetchone()
+        cold_ms = load_ms(lambda: store.get(random.choice(ids)), args.repeat)
+        assert all(store.get(session_id) == entries for session_id, entries in sessions.items())
+        store.close()
+        conn.close()
+
+        print(f"{len(sessions)} sessions, {turns} turns")
+        print(f"{'format':28} {'bytes':>12} {'ms per session load':>20}")
+        print(f"{'legacy JSON (indent=2)':28} {os.path.getsize(json_path):12} {load_ms(load_json, max(1, args.repeat // 20)):20.3f}")
+        print(f"{'turn rows (compact, delta)':28} {hot_bytes:12} {hot_ms:20.3f}")
+        print(f"{'archive (zlib)':28} {cold_bytes:12} {cold_ms:20.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Startup-time budget for the gateway app.
+
+Runs a fresh interpreter (so nothing is already imported) that imports
+`gateway` under `python -X importtime` and serves one request through the
+ASGI app. Reports the import time, the time to the first response and the
+slowest top-level imports, and exits non-zero if either exceeds its budget.
+
+    python benchmarks/startup.py [--runs 5] [--import-budget-ms 600] [--first-request-budget-ms 900]
+
+No network access is needed: the first request hits /chat/session_cache,
+which does not call the model. The child runs in a temporary directory so
+it creates its own empty session database.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import sys
+from time import perf_counter
+start = perf_counter()
+sys.path.insert(0, {root!r})
+import gateway
+imported = perf_counter()
+
+import asyncio
+import httpx
+
+async def first_request():
+    transport = httpx.ASGITransport(app=gateway.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://startup") as c:
+        response = await c.get("/chat/session_cache")
+        response.raise_for_status()
+
+asyncio.run(first_request())
+done = perf_counter()
+print("RESULT", {{"import_ms": (imported - start) * 1000, "first_request_ms": (done - start) * 1000}})
+"""
+
+
+def run_once() -> tuple[dict, list]:
+    with tempfile.TemporaryDirectory() as cwd:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", CHILD.format(root=ROOT)],
+            cwd=cwd, capture_output=True, text=True, check=True,
+        )
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("RESULT "):
+            result = json.loads(line[len("RESULT "):].replace("'", '"'))
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # One leading space, then two more per nesting level; keep the
+        # top-level imports and what they import directly
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(cumulative) / 1000, name.strip()))
+    imports.sort(reverse=True)
+    return result, imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget-ms", type=float, default=600)
+    parser.add_argument("--first-request-budget-ms", type=float, default=900)
+    args = parser.parse_args()
+
+    results = []
+    slowest = []
+    for _ in range(args.runs):
+        result, slowest = run_once()
+        results.append(result)
+
+    import_ms = statistics.median(r["import_ms"] for r in results)
+    first_request_ms = statistics.median(r["first_request_ms"] for r in results)
+
+    print("Slowest imports (last run):")
+    for ms, name in slowest[:10]:
+        print(f"  {ms:8.1f} ms  {name}")
+    print(f"import gateway:      {import_ms:8.1f} ms (budget {args.import_budget_ms:.0f} ms)")
+    print(f"time to first reply: {first_request_ms:8.1f} ms (budget {args.first_request_budget_ms:.0f} ms)")
+
+    failed = []
+    if import_ms > args.import_budget_ms:
+        failed.append("import")
+    if first_request_ms > args.first_request_budget_ms:
+        failed.append("first request")
+    if failed:
+        sys.exit(f"Startup budget exceeded: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
+
+import metrics
+from config import env_vars
+
+if TYPE_CHECKING:
+    import anthropic
+
+_async_client = None
+_unretried_client = None
+
+
+def get_async_client() -> "anthropic.AsyncAnthropic":
+    """
+    Shared AsyncAnthropic client. All requests in the process reuse one
+    pooled httpx transport; pool size and timeouts are tunable through
+    ANTHROPIC_MAX_CONNECTIONS, ANTHROPIC_MAX_KEEPALIVE,
+    ANTHROPIC_KEEPALIVE_EXPIRY, ANTHROPIC_TIMEOUT and
+    ANTHROPIC_CONNECT_TIMEOUT.
+    """
+    global _async_client
+    if _async_client is None:
+        # The SDK is the single slowest import of the app: load it on first use
+        import anthropic
+        import httpx
+
+        http_client = anthropic.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=int(env_vars.get("ANTHROPIC_MAX_CONNECTIONS") or 1000),
+                max_keepalive_connections=int(env_vars.get("ANTHROPIC_MAX_KEEPALIVE") or 200),
+                keepalive_expiry=float(env_vars.get("ANTHROPIC_KEEPALIVE_EXPIRY") or 30),
+            ),
+            timeout=httpx.Timeout(
+                float(env_vars.get("ANTHROPIC_TIMEOUT") or 600),
+                connect=float(env_vars.get("ANTHROPIC_CONNECT_TIMEOUT") or 5),
+            ),
+        )
+        _async_client = anthropic.AsyncAnthropic(
+            api_key=env_vars.get("ANTROPIC_API_KEY"),
+            http_client=http_client,
+        )
+    return _async_client
+
+
+def get_unretried_client() -> "anthropic.AsyncAnthropic":
+    """
+    The shared client with the SDK's own retries turned off (same
+    connection pool), for calls made through resilience.call, which
+    retries under a process-wide budget instead.
+    """
+    global _unretried_client
+    if _unretried_client is None:
+        _unretried_client = get_async_client().with_options(max_retries=0)
+    return _unretried_client
+
+
+async def close_async_client() -> None:
+    global _async_client, _unretried_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+        _unretried_client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """FastAPI lifespan: open the shared client at startup, close its pool at shutdown."""
+    metrics.init_sentry()
+    get_async_client()
+    yield
+    await close_async_client()
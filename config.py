@@ -0,0 +1,4 @@
+from dotenv import dotenv_values
+
+# .env is read once per process and shared by every module
+env_vars = dotenv_values(".env")
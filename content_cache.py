@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+from time import time
+
+from config import env_vars
+from db import SqliteDatabase
+
+CONTENT_CACHE_DB = "content_cache.db"
+
+
+class FileIndex:
+    """
+    Maps the SHA-256 of uploaded bytes to the Files API file_id they were
+    uploaded as, so re-uploading identical content reuses the first
+    file_id, and lets the analysis endpoints find the content hash (and,
+    for PDFs, the page count) of a file_id.
+    """
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+        conn = db.connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                sha256 TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL UNIQUE,
+                filename TEXT,
+                mime_type TEXT,
+                size INTEGER,
+                created_at REAL NOT NULL,
+                page_count INTEGER
+            )
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+        if "page_count" not in columns:
+            # Databases created before page counts were recorded
+            conn.execute("ALTER TABLE files ADD COLUMN page_count INTEGER")
+
+    def file_id_for(self, sha256: str) -> str | None:
+        row = self.db.connect().execute(
+            "SELECT file_id FROM files WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def sha256_for(self, file_id: str) -> str | None:
+        row = self.db.connect().execute(
+            "SELECT sha256 FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def page_count_for(self, file_id: str) -> int | None:
+        row = self.db.connect().execute(
+            "SELECT page_count FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_page_count(self, sha256: str, page_count: int) -> None:
+        self.db.connect().execute(
+            "UPDATE files SET page_count = ? WHERE sha256 = ?", (page_count, sha256)
+        )
+
+    def add(self, sha256: str, file_id: str, filename: str | None = None,
+            mime_type: str | None = None, size: int | None = None,
+            page_count: int | None = None) -> None:
+        self.db.connect().execute(
+            "INSERT OR REPLACE INTO files (sha256, file_id, filename, mime_type, size, created_at, page_count) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sha256, file_id, filename, mime_type, size, time(), page_count),
+        )
+
+
+class ResultCache:
+    """
+    Persistent cache of endpoint results keyed by
+    (content key, endpoint, version). The version should change whenever
+    the prompt, schema or model of the endpoint changes. Once the stored
+    results exceed `max_bytes`, the least recently used ones are evicted.
+    """
+
+    def __init__(self, db: SqliteDatabase, max_bytes: int = 256 * 1024 * 1024):
+        self.db = db
+        self.max_bytes = max_bytes
+        db.connect().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+            """
+        )
+
+    def get(self, content_key: str, endpoint: str, version: str):
+        key = _result_key(content_key, endpoint, version)
+        conn = self.db.connect()
+        row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time(), key))
+        return json.loads(row[0])
+
+    def put(self, content_key: str, endpoint: str, version: str, value) -> None:
+        data = json.dumps(value)
+        conn = self.db.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (_result_key(content_key, endpoint, version), data, len(data), time()),
+            )
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn):
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we are back under the cap
+        for key, size in conn.execute(
+            "SELECT key, size FROM results ORDER BY last_access"
+        ).fetchall():
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+class SearchCache:
+    """
+    Web-search results keyed by (jurisdiction key, query), see
+    legal_context. Entries older than `ttl` seconds are ignored and
+    purged; once the stored results exceed `max_bytes`, the oldest are
+    evicted.
+    """
+
+    def __init__(self, db: SqliteDatabase, ttl: float = 7 * 24 * 3600, max_bytes: int = 32 * 1024 * 1024):
+        self.db = db
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        db.connect().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS searches (
+                jurisdiction TEXT NOT NULL,
+                query TEXT NOT NULL,
+                results TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (jurisdiction, query)
+            );
+            CREATE INDEX IF NOT EXISTS searches_created_at ON searches (created_at);
+            """
+        )
+
+    def get(self, jurisdiction: str, limit: int = 20) -> list[tuple[str, list]]:
+        """Fresh (query, results) for a jurisdiction, newest first."""
+        rows = self.db.connect().execute(
+            "SELECT query, results FROM searches WHERE jurisdiction = ? AND created_at > ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (jurisdiction, time() - self.ttl, limit),
+        ).fetchall()
+        return [(query, json.loads(results)) for query, results in rows]
+
+    def put(self, jurisdiction: str, searches: list[tuple[str, list]]) -> None:
+        conn = self.db.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time()
+            for query, results in searches:
+                data = json.dumps(results)
+                conn.execute(
+                    "INSERT OR REPLACE INTO searches (jurisdiction, query, results, size, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (jurisdiction, query, data, len(data), now),
+                )
+            conn.execute("DELETE FROM searches WHERE created_at <= ?", (now - self.ttl,))
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn):
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM searches").fetchone()
+        if total <= self.max_bytes:
+            return
+        for jurisdiction, query, size in conn.execute(
+            "SELECT jurisdiction, query, size FROM searches ORDER BY created_at"
+        ).fetchall():
+            conn.execute(
+                "DELETE FROM searches WHERE jurisdiction = ? AND query = ?", (jurisdiction, query)
+            )
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def _result_key(content_key: str, endpoint: str, version: str) -> str:
+    return f"{endpoint}:{version}:{content_key}"
+
+
+def cache_version(*parts) -> str:
+    """Short stable hash of everything that shapes an endpoint's output (prompt, schema, model)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+async def content_key_for(file_id: str) -> str:
+    """Content hash of an uploaded file, or the file_id itself if it was uploaded elsewhere."""
+    sha256 = await asyncio.to_thread(get_file_index().sha256_for, file_id)
+    return f"sha256:{sha256}" if sha256 else f"file_id:{file_id}"
+
+
+_db = None
+_file_index = None
+_result_cache = None
+_search_cache = None
+
+
+def _get_db() -> SqliteDatabase:
+    global _db
+    if _db is None:
+        _db = SqliteDatabase(env_vars.get("CONTENT_CACHE_DB") or CONTENT_CACHE_DB)
+    return _db
+
+
+def get_file_index() -> FileIndex:
+    global _file_index
+    if _file_index is None:
+        _file_index = FileIndex(_get_db())
+    return _file_index
+
+
+def get_result_cache() -> ResultCache:
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(
+            _get_db(),
+            max_bytes=int(env_vars.get("CONTENT_CACHE_MAX_BYTES") or 256 * 1024 * 1024),
+        )
+    return _result_cache
+
+
+def get_search_cache() -> SearchCache:
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = SearchCache(
+            _get_db(),
+            ttl=float(env_vars.get("SEARCH_CACHE_TTL") or 7 * 24 * 3600),
+            max_bytes=int(env_vars.get("SEARCH_CACHE_MAX_BYTES") or 32 * 1024 * 1024),
+        )
+    return _search_cache
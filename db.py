@@ -0,0 +1,30 @@
+import sqlite3
+import threading
+
+
+class SqliteDatabase:
+    """
+    SQLite file in WAL mode with one connection per thread (sqlite3
+    connections must not be shared between threads). Connections are in
+    autocommit mode; use BEGIN IMMEDIATE explicitly for multi-statement
+    writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -1,13 +1,21 @@
-import anthropic
-from fastapi import FastAPI, HTTPException
-from dotenv import dotenv_values
-import json
-import re
+import asyncio
+import admission
+import clients
+import content_cache
+import metrics
+import ocr
+import resilience
+from fastapi import APIRouter, FastAPI, HTTPException
+from pydantic import BaseModel
+from config import env_vars
+from response_decoder import decode_response, response_model
 
-env_vars = dotenv_values(".env")
-client = anthropic.Anthropic(api_key=env_vars.get("ANTROPIC_API_KEY"))
+# Upper bound on in-flight upstream calls from this endpoint; analysis is bulk work
+admission.scheduler.configure(
+    "/doc_analysis", int(env_vars.get("DOC_ANALYSIS_CONCURRENCY") or 16), admission.BULK
+)
 
-app = FastAPI(title="GpsLaw.AI DOC Analysis API")
+router = APIRouter()
 
 system_prompt = """
 Role:
@@ -116,80 +124,356 @@ DOC_TEXT_FORMAT = {
     # "strict": True
 }
 
-def extract_json(text: str):
+DOC_MODEL = "claude-sonnet-4-5"
+FILES_API_BETA = "files-api-2025-04-14"
+
+# Message Batches accept up to 100,000 requests; keep single submissions smaller
+MAX_BATCH_DOCUMENTS = int(env_vars.get("MAX_BATCH_DOCUMENTS") or 1000)
+BATCH_POLL_INTERVAL = float(env_vars.get("BATCH_POLL_INTERVAL") or 30)
+
+# Background batch pollers, kept referenced until they finish
+callback_tasks = set()
+
+# Cached analyses are invalidated whenever the prompt, schema or model changes
+DOC_CACHE_VERSION = content_cache.cache_version(system_prompt, DOC_TEXT_FORMAT, DOC_MODEL)
+
+DocAnalysisReply = response_model("DocAnalysisReply", DOC_TEXT_FORMAT)
+
+
+def analysis_params(file_id: str, mime_type: str, text: str | None = None) -> dict:
     """
-    Extract valid JSON from model output.
+    Messages API parameters for analysing one uploaded file. With `text`,
+    the file's OCR transcription, the model reads that plain text instead
+    of the file, which costs far fewer input tokens than PDF pages or images.
     """
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if not match:
-        return None
+    file_type = "image" if mime_type.startswith("image/") else "document"
+    if text is not None:
+        document = {
+            "type": "document",
+            "source": {
+                "type": "text",
+                "media_type": "text/plain",
+                "data": text
+            }
+        }
+    else:
+        document = {
+            "type": file_type,
+            "source": {
+                "type": "file",
+                "file_id": file_id
+            }
+        }
 
-    try:
-        return json.loads(match.group(0))
-    except json.JSONDecodeError:
-        return None
+    return dict(
+        model=DOC_MODEL,
+        max_tokens=8192,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": system_prompt
+                    },
+                    document
+                ]
+            }
+        ],
+        output_config={
+            "format": DOC_TEXT_FORMAT
+        }
+    )
+
+
+def parse_analysis(ai_reply: str) -> dict:
+    """Decode a DOC_TEXT_FORMAT reply into the /doc_analysis response fields."""
+    response_json = decode_response(ai_reply, DocAnalysisReply)
+    localization = response_json.get("localization", {})
+    potential_risks = response_json.get("potential_risks", [])
+    key_clauses = response_json.get("key_clauses", [])
+    ai_recommendation = response_json.get("ai_recommendation", [])
+    summary = response_json.get("summary", "")
+
+    return {
+        "summary": summary,
+        "localization": localization,
+        "potential_risks": potential_risks,
+        "key_clauses": key_clauses,
+        "ai_recommendation": ai_recommendation
+    }
+
+
+# Seconds after which a still-running analysis is hedged with a second call; 0 disables hedging
+DOC_ANALYSIS_HEDGE_AFTER = float(env_vars.get("DOC_ANALYSIS_HEDGE_AFTER") or 0)
+
+# Duplicate requests for a document already being analysed wait for that call
+doc_analysis_inflight = resilience.SingleFlight("/doc_analysis")
+
+DOC_ANALYSIS_SOURCES = metrics.Counter(
+    "gpslaw_doc_analysis_source_total",
+    "Document analyses run on the stored OCR text of the file or on the file itself.",
+    ("endpoint", "source"),
+)
+
+
+async def analyse_document(file_id: str, mime_type: str, content_key: str, text: str | None = None,
+                           endpoint: str = "/doc_analysis") -> dict:
+    """One analysis call for a file, or for its OCR `text`; the result is cached by content."""
+    DOC_ANALYSIS_SOURCES.inc(endpoint=endpoint, source="file" if text is None else "ocr_text")
+
+    params = analysis_params(file_id, mime_type, text)
 
-@app.post("/doc_analysis")
+    async def attempt():
+        # /extract_and_analyze calls share the /doc_analysis limit
+        async with admission.admit("/doc_analysis", params) as ticket:
+            response = await clients.get_unretried_client().beta.messages.create(
+                **params,
+                betas=[FILES_API_BETA]
+            )
+        admission.settle(ticket, response.usage)
+        return response
+
+    with metrics.span(endpoint, "model_call"):
+        response = await resilience.call(attempt, endpoint, DOC_ANALYSIS_HEDGE_AFTER)
+    metrics.record_usage(endpoint, response.usage)
+
+    with metrics.span(endpoint, "decode"):
+        result = parse_analysis(response.content[0].text)
+    with metrics.span(endpoint, "cache_store"):
+        await asyncio.to_thread(
+            content_cache.get_result_cache().put, content_key, "doc_analysis", DOC_CACHE_VERSION, result
+        )
+    return result
+
+
+@router.post("/doc_analysis")
 async def extract_user_details(file_id: str, mime_type: str):
     """
     file_id: OpenAI uploaded file ID (from another API)
     """
     try:
-        file_type = "image" if mime_type.startswith("image/") else "document"
+        with metrics.span("/doc_analysis", "cache_lookup"):
+            content_key = await content_cache.content_key_for(file_id)
+            cached = await asyncio.to_thread(
+                content_cache.get_result_cache().get, content_key, "doc_analysis", DOC_CACHE_VERSION
+            )
+        if cached is not None:
+            return {"response": cached}
 
-        response = client.beta.messages.create(
-            model="claude-sonnet-4-5",
-            max_tokens=8192,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": system_prompt
-                        },
-                        {
-                            "type": file_type,
-                            "source": {
-                                "type": "file",
-                                "file_id": file_id
-                            }
-                        }
-                    ]
-                }
-            ],
-            output_config={
-                "format": DOC_TEXT_FORMAT
-            }
-            ,
-            betas=["files-api-2025-04-14"]
+        # A file already OCRed (e.g. by /extract_user_details) is analysed from its text
+        with metrics.span("/doc_analysis", "ocr_text_lookup"):
+            text = await ocr.stored_text(content_key)
+        result = await doc_analysis_inflight.do(
+            (content_key, mime_type),
+            lambda: analyse_document(file_id, mime_type, content_key, text),
         )
 
-        ai_reply = response.content[0].text
-        ai_reply = re.sub(r'^```json\s*', '', ai_reply)
-        ai_reply = re.sub(r'^```\s*', '', ai_reply)
-        ai_reply = re.sub(r'\s*```$', '', ai_reply)
-        ai_reply = ai_reply.strip()
-        
-        response_json = json.loads(ai_reply)
-        localization = response_json.get("localization", {})
-        potential_risks = response_json.get("potential_risks", [])
-        key_clauses = response_json.get("key_clauses", [])
-        ai_recommendation = response_json.get("ai_recommendation", [])
-        summary = response_json.get("summary", "")
+        return {
+            "response": result
+        }
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=resilience.error_status(e),
+            detail=f"OCR processing failed: {str(e)}"
+        )
+
+
+@router.post("/extract_and_analyze")
+async def extract_and_analyze(file_id: str, mime_type: str, page_count: int | None = None):
+    """
+    OCR a file once and analyse the extracted text instead of sending the
+    file to the model a second time. Both results are cached by content,
+    so a later /extract_user_details or /doc_analysis call for the same
+    file is answered from them. page_count is as for /extract_user_details.
+    """
+    try:
+        content_key = await content_cache.content_key_for(file_id)
+        # The analysis may already be cached; look it up while the OCR runs
+        extracted, cached = await asyncio.gather(
+            ocr.extract_text(file_id, mime_type, page_count),
+            asyncio.to_thread(
+                content_cache.get_result_cache().get, content_key, "doc_analysis", DOC_CACHE_VERSION
+            ),
+        )
+        analysis = cached
+        if analysis is None:
+            # Without usable text (nothing extracted) the file itself is analysed
+            text = extracted["data"] if extracted["success"] and extracted["data"].strip() else None
+            analysis = await doc_analysis_inflight.do(
+                (content_key, mime_type),
+                lambda: analyse_document(file_id, mime_type, content_key, text, "/extract_and_analyze"),
+            )
 
         return {
             "response": {
-                "summary": summary,
-                "localization": localization,
-                "potential_risks": potential_risks,
-                "key_clauses": key_clauses,
-                "ai_recommendation": ai_recommendation
+                "ocr": {
+                    "success": extracted["success"],
+                    "data": extracted["data"],
+                    "mime_type": mime_type
+                },
+                "analysis": analysis
             }
         }
 
+    except ocr.PdfTooLong as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=resilience.error_status(e),
+            detail=f"Extraction and analysis failed: {str(e)}"
+        )
+
+
+class BatchDocument(BaseModel):
+    file_id: str
+    mime_type: str
+
+
+class BatchAnalysisRequest(BaseModel):
+    documents: list[BatchDocument]
+    # Optional URL that receives the results (same body as GET .../results) once the batch ends
+    callback_url: str | None = None
+
+
+def batch_status(batch) -> dict:
+    return {
+        "batch_id": batch.id,
+        "processing_status": batch.processing_status,
+        "request_counts": batch.request_counts.model_dump(),
+        "created_at": batch.created_at.isoformat(),
+        "ended_at": batch.ended_at.isoformat() if batch.ended_at else None
+    }
+
+
+async def batch_results(batch_id: str) -> list[dict]:
+    """Per-document results of an ended batch, in submission order."""
+    results = []
+    async for entry in await clients.get_async_client().beta.messages.batches.results(batch_id):
+        index, file_id = entry.custom_id.split("-", 1)
+        item = {"file_id": file_id, "status": entry.result.type}
+        if entry.result.type == "succeeded":
+            try:
+                item["response"] = parse_analysis(entry.result.message.content[0].text)
+            except Exception as e:
+                item["status"] = "errored"
+                item["error"] = f"Invalid analysis output: {str(e)}"
+            else:
+                # Batch results also warm the cache used by /doc_analysis
+                content_key = await content_cache.content_key_for(file_id)
+                await asyncio.to_thread(
+                    content_cache.get_result_cache().put, content_key, "doc_analysis",
+                    DOC_CACHE_VERSION, item["response"]
+                )
+        elif entry.result.type == "errored":
+            item["error"] = entry.result.error.error.message
+        results.append((int(index), item))
+    return [item for _, item in sorted(results, key=lambda pair: pair[0])]
+
+
+async def stored_text_for(file_id: str) -> str | None:
+    return await ocr.stored_text(await content_cache.content_key_for(file_id))
+
+
+async def notify_when_done(batch_id: str, callback_url: str) -> None:
+    """Poll a batch until it ends, then POST its results to callback_url."""
+    import httpx
+
+    try:
+        while True:
+            batch = await clients.get_async_client().beta.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                break
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+        body = {**batch_status(batch), "results": await batch_results(batch_id)}
+        async with httpx.AsyncClient(timeout=30) as http:
+            await http.post(callback_url, json=body)
+    except Exception as e:
+        print(f"Batch {batch_id} callback to {callback_url} failed: {e}")
+
+
+@router.post("/doc_analysis/batch")
+async def create_batch_analysis(request: BatchAnalysisRequest):
+    """
+    Submit many documents as one Message Batch. Poll
+    GET /doc_analysis/batch/{batch_id} and fetch
+    GET /doc_analysis/batch/{batch_id}/results once it has ended, or pass
+    callback_url to have the results POSTed there.
+    """
+    if not request.documents:
+        raise HTTPException(status_code=400, detail="No documents to analyse.")
+    if len(request.documents) > MAX_BATCH_DOCUMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_DOCUMENTS} documents per batch."
+        )
+
+    try:
+        # Documents already OCRed are submitted as their text
+        texts = await asyncio.gather(*(
+            stored_text_for(document.file_id) for document in request.documents
+        ))
+        batch = await clients.get_async_client().beta.messages.batches.create(
+            requests=[
+                {
+                    # custom_id carries the position and file_id back with each result
+                    "custom_id": f"{index}-{document.file_id}",
+                    "params": analysis_params(document.file_id, document.mime_type, text)
+                }
+                for index, (document, text) in enumerate(zip(request.documents, texts))
+            ],
+            betas=[FILES_API_BETA]
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
-            detail=f"OCR processing failed: {str(e)}"
+            detail=f"Batch submission failed: {str(e)}"
         )
+
+    if request.callback_url:
+        task = asyncio.create_task(notify_when_done(batch.id, request.callback_url))
+        callback_tasks.add(task)
+        task.add_done_callback(callback_tasks.discard)
+
+    return batch_status(batch)
+
+
+@router.get("/doc_analysis/batch/{batch_id}")
+async def get_batch_analysis(batch_id: str):
+    try:
+        batch = await clients.get_async_client().beta.messages.batches.retrieve(batch_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Batch lookup failed: {str(e)}"
+        )
+    return batch_status(batch)
+
+
+@router.get("/doc_analysis/batch/{batch_id}/results")
+async def get_batch_analysis_results(batch_id: str):
+    try:
+        batch = await clients.get_async_client().beta.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            raise HTTPException(
+                status_code=409,
+                detail=f"Batch is still {batch.processing_status}."
+            )
+        return {**batch_status(batch), "results": await batch_results(batch_id)}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Batch results failed: {str(e)}"
+        )
+
+
+# Standalone app, kept for deployments that still run `uvicorn doc_ai_analysis:app`
+app = FastAPI(title="GpsLaw.AI DOC Analysis API", lifespan=clients.lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(router)
+app.include_router(metrics.router)
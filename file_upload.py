@@ -1,14 +1,86 @@
-import anthropic
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from dotenv import dotenv_values
-import io
+import asyncio
+import clients
+import content_cache
+import metrics
+import hashlib
+from fastapi import APIRouter, FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse
+from pypdf import PdfReader
+from config import env_vars
 
-env_vars = dotenv_values(".env")
-client = anthropic.Anthropic(api_key=env_vars.get("ANTROPIC_API_KEY"))
+# Upper bound on in-flight upstream calls from this endpoint
+upload_slots = asyncio.Semaphore(int(env_vars.get("UPLOAD_CONCURRENCY") or 8))
 
-app = FastAPI(title="GpsLaw.AI File Upload API")
+# Largest accepted file; bigger uploads are rejected before being read in full
+MAX_UPLOAD_BYTES = int(env_vars.get("MAX_UPLOAD_BYTES") or 100 * 1024 * 1024)
+# Room for the multipart boundaries and headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
 
-@app.post("/upload_file")
+
+def upload_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"File too large. The maximum upload size is {MAX_UPLOAD_BYTES / (1024 * 1024):g} MB."
+    )
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects oversized /upload_file bodies early: from Content-Length when
+    the client sends it, otherwise as soon as the streamed body passes the
+    limit, instead of after the whole body has been spooled.
+    """
+
+    def __init__(self, app, path: str = "/upload_file"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        max_body = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and int(content_length) > max_body:
+            error = upload_too_large()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    # Propagates out of the body parser as a 413 response
+                    raise upload_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def pdf_page_count(file) -> int | None:
+    """
+    Page count of a PDF, read from /Count of the document's page tree as
+    of its latest revision, so page objects superseded by incremental
+    updates (signatures, annotations) are not counted. None if the file
+    cannot be parsed.
+    """
+    try:
+        return len(PdfReader(file, strict=False).pages) or None
+    except Exception as e:
+        print(f"Could not read the PDF page count: {e}")
+        return None
+
+
+router = APIRouter()
+
+@router.post("/upload_file")
 async def upload_file(file: UploadFile = File(...)):
     if file.content_type not in ["application/pdf", "text/plain", "image/png", "image/jpeg", "image/gif", "image/webp"]:
         raise HTTPException(
@@ -16,22 +88,64 @@ async def upload_file(file: UploadFile = File(...)):
             detail="Unsupported file type. Only image, PDF, and document files are accepted."
         )
         
+    # The multipart parser has already spooled the file to a temporary file;
+    # hash it chunk by chunk instead of reading it into memory
+    with metrics.span("/upload_file", "hash"):
+        digest = hashlib.sha256()
+        size = 0
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise upload_too_large()
+            digest.update(chunk)
+        sha256 = digest.hexdigest()
+
+    page_count = None
+    if file.content_type == "application/pdf":
+        with metrics.span("/upload_file", "page_count"):
+            await file.seek(0)
+            page_count = await asyncio.to_thread(pdf_page_count, file.file)
+
     try:
-        file_content = await file.read()
+
+        # Identical bytes were uploaded before: reuse that file_id
+        file_index = content_cache.get_file_index()
+        with metrics.span("/upload_file", "index_lookup"):
+            file_id = await asyncio.to_thread(file_index.file_id_for, sha256)
+        if file_id:
+            if page_count is not None:
+                # Replaces a count recorded by an earlier version of this endpoint
+                await asyncio.to_thread(file_index.set_page_count, sha256, page_count)
+            return {
+                "filename": file.filename,
+                "content_type": file.content_type,
+                "file_id": file_id,
+                "mime_type": file.content_type,
+                "sha256": sha256,
+                "page_count": page_count
+            }
             
-        file_bytes = io.BytesIO(file_content)
-        file_bytes.name = file.filename 
         mime_type = file.content_type
-        
-        uploaded_file = client.beta.files.upload(
-            file=(file.filename, file_bytes, file.content_type)
-        )
+
+        # Hand the spooled file object to the client, which streams it in chunks
+        await file.seek(0)
+        with metrics.span("/upload_file", "files_upload"):
+            async with upload_slots:
+                uploaded_file = await clients.get_async_client().beta.files.upload(
+                    file=(file.filename, file.file, file.content_type)
+                )
+        with metrics.span("/upload_file", "index_store"):
+            await asyncio.to_thread(
+                file_index.add, sha256, uploaded_file.id, file.filename, mime_type, size, page_count
+            )
 
         return {
             "filename": file.filename,
             "content_type": file.content_type,
             "file_id": uploaded_file.id,
-            "mime_type": mime_type
+            "mime_type": mime_type,
+            "sha256": sha256,
+            "page_count": page_count
         }
         
     except Exception as e:
@@ -39,6 +153,14 @@ async def upload_file(file: UploadFile = File(...)):
             status_code=500,
             detail=f"File upload failed: {str(e)}"
         )
-        
-        
-# file_011CXicihbWgzhGH1nmjWosk
\ No newline at end of file
+
+
+
+# Standalone app, kept for deployments that still run `uvicorn file_upload:app`
+app = FastAPI(title="GpsLaw.AI File Upload API", lifespan=clients.lifespan)
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(router)
+app.include_router(metrics.router)
+
+# file_011CXicihbWgzhGH1nmjWosk
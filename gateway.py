@@ -0,0 +1,25 @@
+"""
+Single-process GpsLaw.AI API: chat, OCR, document analysis and file
+upload served by one app that shares one pooled Anthropic client and one
+copy of the configuration.
+
+    uvicorn gateway:app
+"""
+from fastapi import FastAPI
+
+import ai_chat
+import clients
+import doc_ai_analysis
+import file_upload
+import metrics
+import ocr
+
+app = FastAPI(title="GpsLaw.AI API", lifespan=clients.lifespan)
+app.add_middleware(file_upload.UploadSizeLimitMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+app.include_router(ai_chat.router)
+app.include_router(ocr.router)
+app.include_router(doc_ai_analysis.router)
+app.include_router(file_upload.router)
+app.include_router(metrics.router)
@@ -0,0 +1,102 @@
+"""
+Reuse of web-search results across sessions that resolve to the same
+jurisdiction. Searches made by the guidance model are collected from its
+replies and stored in content_cache.SearchCache under the normalized
+localization; later guidance turns for that jurisdiction get them as an
+extra prompt block, so the model only searches for what they do not cover.
+The web_search tool stays available: the cached queries were made for
+other cases in the same jurisdiction, not for this one.
+"""
+import re
+import unicodedata
+
+MAX_RESULTS_PER_QUERY = 5
+MAX_SNIPPETS_PER_RESULT = 3
+
+
+def _normalize(value) -> str:
+    text = unicodedata.normalize("NFKD", str(value or "")).encode("ascii", "ignore").decode()
+    return " ".join(text.lower().replace("/", " ").split())
+
+
+def lookup_key(value) -> str | None:
+    """
+    A free-text localization field reduced to lowercase ASCII words, for
+    matching, e.g. "Employment / Unpaid wages (Salaires impayés)" ->
+    "employment unpaid wages salaires impayes". None if nothing is left.
+    """
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", _normalize(value)).split()) or None
+
+
+def jurisdiction_key(localization: dict | None) -> str | None:
+    """
+    Cache key for a localization, e.g. "france|civil law|france|employment law".
+    None until the country and the legal domain are both known.
+    """
+    if not localization:
+        return None
+    parts = [
+        _normalize(localization.get(field))
+        for field in ("country", "legal_system", "jurisdiction", "legal_domain")
+    ]
+    if not parts[0] or not parts[3]:
+        return None
+    return "|".join(parts)
+
+
+def extract_searches(message) -> list[tuple[str, list[dict]]]:
+    """
+    (query, results) for every web search in a Messages API reply. Each
+    result keeps its title, url, page_age and the passages the reply cited
+    from it (the search results themselves only come back encrypted).
+    """
+    queries = {}
+    results = {}
+    snippets = {}
+    for block in message.content:
+        if block.type == "server_tool_use" and block.name == "web_search":
+            queries[block.id] = block.input.get("query", "")
+        elif block.type == "web_search_tool_result" and isinstance(block.content, list):
+            results[block.tool_use_id] = [
+                {"title": r.title, "url": r.url, "page_age": r.page_age}
+                for r in block.content[:MAX_RESULTS_PER_QUERY]
+            ]
+        elif block.type == "text":
+            for citation in block.citations or []:
+                if citation.type == "web_search_result_location" and citation.cited_text:
+                    snippets.setdefault(citation.url, []).append(citation.cited_text)
+
+    searches = []
+    for tool_use_id, query in queries.items():
+        if not query or tool_use_id not in results:
+            continue
+        for result in results[tool_use_id]:
+            result["snippets"] = snippets.get(result["url"], [])[:MAX_SNIPPETS_PER_RESULT]
+        searches.append((query, results[tool_use_id]))
+    return searches
+
+
+def context_block(searches: list[tuple[str, list[dict]]], max_chars: int) -> str | None:
+    """Prompt text listing cached searches and their results, cut at `max_chars`; None if empty."""
+    lines = []
+    seen = set()
+    for query, results in searches:
+        entry = [f'Search: "{query}"']
+        for result in results:
+            if result["url"] in seen:
+                continue
+            seen.add(result["url"])
+            entry.append(f"- {result['title']} ({result['url']})")
+            entry.extend(f'  "{snippet}"' for snippet in result.get("snippets", []))
+        if len(entry) > 1:
+            lines.extend(entry)
+    if not lines:
+        return None
+    text = "\n".join(lines)[:max_chars]
+    return (
+        "### LEGAL RESEARCH CONTEXT:\n"
+        "Web searches already made for other cases in this jurisdiction and legal domain. Use "
+        "these sources where they apply to this case and cite their URLs; search the web only "
+        "for what they do not cover.\n"
+        f"{text}\n"
+    )
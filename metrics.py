@@ -0,0 +1,192 @@
+"""
+Per-request latency and token metrics in the Prometheus text format,
+served at GET /metrics. Stage timings are also reported as Sentry spans
+when SENTRY_DSN is configured.
+"""
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from config import env_vars
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+
+def _label_str(labelnames, values) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_str(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts, sum, count]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _label_str(self.labelnames + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _label_str(self.labelnames + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _label_str(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def register_collector(fn) -> None:
+    """`fn()` returns extra exposition lines (e.g. gauges read from a cache) at scrape time."""
+    _collectors.append(fn)
+
+
+REQUEST_SECONDS = Histogram(
+    "gpslaw_request_duration_seconds", "End-to-end request latency.", ("endpoint", "status")
+)
+STAGE_SECONDS = Histogram(
+    "gpslaw_stage_duration_seconds", "Latency of one stage of a request.", ("endpoint", "stage")
+)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "gpslaw_time_to_first_token_seconds", "Time from model request to first streamed token.", ("endpoint",)
+)
+TOKENS = Counter(
+    "gpslaw_tokens_total", "Model tokens by kind (input, output, cache_read, cache_creation).", ("endpoint", "kind")
+)
+
+_sentry_enabled = False
+
+
+def init_sentry() -> None:
+    """Start Sentry tracing if SENTRY_DSN is set; its FastAPI integration opens a transaction per request."""
+    global _sentry_enabled
+    dsn = env_vars.get("SENTRY_DSN")
+    if not dsn or _sentry_enabled:
+        return
+    import sentry_sdk
+
+    sentry_sdk.init(
+        dsn=dsn,
+        traces_sample_rate=float(env_vars.get("SENTRY_TRACES_SAMPLE_RATE") or 0.1),
+    )
+    _sentry_enabled = True
+
+
+@contextmanager
+def span(endpoint: str, stage: str):
+    """Time one stage of a request (session_load, model_call, decode, ...)."""
+    sentry_span = None
+    if _sentry_enabled:
+        import sentry_sdk
+
+        sentry_span = sentry_sdk.start_span(op=f"gpslaw.{stage}", name=f"{endpoint} {stage}")
+        sentry_span.__enter__()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(perf_counter() - start, endpoint=endpoint, stage=stage)
+        if sentry_span is not None:
+            sentry_span.__exit__(None, None, None)
+
+
+def record_usage(endpoint: str, usage) -> None:
+    """Count input/output/cached tokens from a Messages API usage object."""
+    TOKENS.inc(usage.input_tokens or 0, endpoint=endpoint, kind="input")
+    TOKENS.inc(usage.output_tokens or 0, endpoint=endpoint, kind="output")
+    TOKENS.inc(getattr(usage, "cache_read_input_tokens", None) or 0, endpoint=endpoint, kind="cache_read")
+    TOKENS.inc(getattr(usage, "cache_creation_input_tokens", None) or 0, endpoint=endpoint, kind="cache_creation")
+
+
+class MetricsMiddleware:
+    """Records REQUEST_SECONDS per route template (not raw path, to keep label cardinality bounded)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                REQUEST_SECONDS.observe(
+                    perf_counter() - start, endpoint=route.path, status=status
+                )
+
+
+def render() -> str:
+    with _lock:
+        lines = []
+        for metric in _metrics:
+            lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,13 +1,19 @@
-import anthropic
-from fastapi import FastAPI, HTTPException
-from dotenv import dotenv_values
-import json
-import re
+import asyncio
+import admission
+import clients
+import content_cache
+import metrics
+import resilience
+from fastapi import APIRouter, FastAPI, HTTPException
+from config import env_vars
+from response_decoder import decode_response, response_model
 
-env_vars = dotenv_values(".env")
-client = anthropic.Anthropic(api_key=env_vars.get("ANTROPIC_API_KEY"))
+# Upper bound on in-flight upstream calls from this endpoint; OCR is bulk work
+admission.scheduler.configure(
+    "/extract_user_details", int(env_vars.get("OCR_CONCURRENCY") or 16), admission.BULK
+)
 
-app = FastAPI(title="GpsLaw.AI OCR API")
+router = APIRouter()
 
 OCR_TEXT_FORMAT = {
     "type": "json_schema",
@@ -33,71 +39,260 @@ OCR_TEXT_FORMAT = {
     # "strict": True
 }
 
-def extract_json(text: str):
+OCR_MODEL = "claude-sonnet-4-5"
+
+OCR_PROMPT = """
+        You are an OCR data extraction assistant.
+
+        Extract text from the provided document and return ONLY valid JSON.
+        No markdown, no explanations, no extra text, no summary.
+        """
+
+# Cached OCR results are invalidated whenever the prompt, schema or model changes
+OCR_CACHE_VERSION = content_cache.cache_version(OCR_PROMPT, OCR_TEXT_FORMAT, OCR_MODEL)
+
+OcrReply = response_model("OcrReply", OCR_TEXT_FORMAT)
+
+OCR_MAX_TOKENS = 8192
+
+# PDFs with more pages than this are OCRed in page ranges of this size,
+# at most OCR_CHUNK_PARALLELISM ranges of one document at a time
+OCR_CHUNK_PAGES = int(env_vars.get("OCR_CHUNK_PAGES") or 10)
+OCR_CHUNK_PARALLELISM = int(env_vars.get("OCR_CHUNK_PARALLELISM") or 4)
+
+# Seconds after which a still-running OCR call is hedged with a second one; 0 disables hedging
+OCR_HEDGE_AFTER = float(env_vars.get("OCR_HEDGE_AFTER") or 0)
+
+# Duplicate requests for a document already being OCRed wait for that call
+ocr_inflight = resilience.SingleFlight("/extract_user_details")
+
+OCR_RANGE_PROMPT = """
+        Only extract the text of pages {first} to {last} of the document (the first page is page 1),
+        in reading order. Ignore every other page.
+        """
+
+OCR_RANGE_CACHE_VERSION = content_cache.cache_version(
+    OCR_PROMPT, OCR_RANGE_PROMPT, OCR_TEXT_FORMAT, OCR_MODEL
+)
+
+
+class OcrTruncated(Exception):
+    """The transcription did not fit in OCR_MAX_TOKENS."""
+
+
+# Every OCR request carries the whole PDF, so no page range can help past
+# the API's limit on pages per request
+OCR_MAX_PDF_PAGES = int(env_vars.get("OCR_MAX_PDF_PAGES") or 100)
+
+
+class PdfTooLong(Exception):
+    """The PDF has more pages than one API request accepts."""
+
+
+async def ocr_request(file_id: str, file_type: str, pages: tuple[int, int] | None = None) -> dict:
     """
-    Extract valid JSON from model output.
+    One OCR call for the whole file, or for `pages` (first, last) of a PDF.
+    Page-range requests put the document first and mark it for prompt
+    caching, so the other ranges of the same file read it from the cache.
     """
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if not match:
-        return None
+    document = {
+        "type": file_type,
+        "source": {
+            "type": "file",
+            "file_id": file_id
+        }
+    }
+    if pages is None:
+        content = [
+            {
+                "type": "text",
+                "text": OCR_PROMPT
+            },
+            document
+        ]
+    else:
+        content = [
+            {**document, "cache_control": {"type": "ephemeral"}},
+            {
+                "type": "text",
+                "text": OCR_PROMPT + OCR_RANGE_PROMPT.format(first=pages[0], last=pages[1])
+            }
+        ]
 
-    try:
-        return json.loads(match.group(0))
-    except json.JSONDecodeError:
-        return None
+    params = dict(
+        model=OCR_MODEL,
+        max_tokens=OCR_MAX_TOKENS,
+        messages=[
+            {
+                "role": "user",
+                "content": content
+            }
+        ],
+        output_config={
+            "format": OCR_TEXT_FORMAT
+        }
+    )
+
+    async def attempt():
+        async with admission.admit("/extract_user_details", params) as ticket:
+            response = await clients.get_unretried_client().beta.messages.create(
+                **params,
+                betas=["files-api-2025-04-14"]
+            )
+        admission.settle(ticket, response.usage)
+        return response
+
+    with metrics.span("/extract_user_details", "model_call"):
+        response = await resilience.call(attempt, "/extract_user_details", OCR_HEDGE_AFTER)
+
+    metrics.record_usage("/extract_user_details", response.usage)
+    if response.stop_reason == "max_tokens":
+        raise OcrTruncated(f"OCR output exceeded {OCR_MAX_TOKENS} tokens")
+
+    with metrics.span("/extract_user_details", "decode"):
+        response_json = decode_response(response.content[0].text, OcrReply)
+    return {"success": response_json.get("success", False), "data": response_json.get("data", "")}
+
+
+def page_ranges(page_count: int, size: int) -> list[tuple[int, int]]:
+    return [(first, min(first + size - 1, page_count)) for first in range(1, page_count + 1, size)]
 
-@app.post("/extract_user_details")
-async def extract_user_details(file_id: str, mime_type: str):
+
+async def ocr_page_range(file_id: str, content_key: str, first: int, last: int) -> dict:
     """
-    file_id: OpenAI uploaded file ID (from another API)
+    OCR pages first..last, cached per range. A range whose text does not
+    fit in one reply is split in half and retried.
     """
+    range_key = f"{content_key}:pages:{first}-{last}"
+    cached = await asyncio.to_thread(
+        content_cache.get_result_cache().get, range_key, "ocr", OCR_RANGE_CACHE_VERSION
+    )
+    if cached is not None:
+        return cached
+
     try:
-        prompt = """
-        You are an OCR data extraction assistant.
+        result = await ocr_request(file_id, "document", (first, last))
+    except OcrTruncated:
+        if first == last:
+            raise
+        middle = (first + last) // 2
+        halves = await asyncio.gather(
+            ocr_page_range(file_id, content_key, first, middle),
+            ocr_page_range(file_id, content_key, middle + 1, last),
+        )
+        result = {
+            "success": all(half["success"] for half in halves),
+            "data": "\n\n".join(half["data"] for half in halves if half["data"]),
+        }
 
-        Extract text from the provided document and return ONLY valid JSON.
-        No markdown, no explanations, no extra text, no summary.
-        """
-        
+    if result["success"]:
+        await asyncio.to_thread(
+            content_cache.get_result_cache().put, range_key, "ocr", OCR_RANGE_CACHE_VERSION, result
+        )
+    return result
+
+
+async def ocr_chunked(file_id: str, content_key: str, page_count: int) -> dict:
+    """
+    OCR a long PDF as concurrent page ranges and join their text in page
+    order. The first range runs alone so that it writes the document to
+    the prompt cache and the others read it from there. Ranges that
+    succeed are cached on their own, so after a failure a retry only
+    redoes the ranges that failed.
+    """
+    parallel = asyncio.Semaphore(OCR_CHUNK_PARALLELISM)
+
+    async def run(first: int, last: int) -> dict:
+        async with parallel:
+            return await ocr_page_range(file_id, content_key, first, last)
+
+    ranges = page_ranges(page_count, OCR_CHUNK_PAGES)
+    first_result = (await asyncio.gather(run(*ranges[0]), return_exceptions=True))[0]
+    results = [first_result] + await asyncio.gather(
+        *(run(*pages) for pages in ranges[1:]), return_exceptions=True
+    )
+
+    failed = [
+        f"pages {first}-{last}: {result}"
+        for (first, last), result in zip(ranges, results)
+        if isinstance(result, Exception)
+    ]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(ranges)} page ranges failed ({'; '.join(failed)}). "
+            "Completed ranges are cached and will not be redone on retry."
+        )
+    return {
+        "success": all(result["success"] for result in results),
+        "data": "\n\n".join(result["data"] for result in results if result["data"]),
+    }
+
+
+async def ocr_document(file_id: str, content_key: str, mime_type: str, page_count: int | None) -> dict:
+    """OCR a whole file, in page ranges if it is a long PDF, and cache the result if it succeeded."""
+    if mime_type == "application/pdf" and page_count and page_count > OCR_CHUNK_PAGES:
+        result = await ocr_chunked(file_id, content_key, page_count)
+    else:
         file_type = "image" if mime_type.startswith("image/") else "document"
+        result = await ocr_request(file_id, file_type)
 
-        response = client.beta.messages.create(
-            model="claude-sonnet-4-5",
-            max_tokens=8192,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": file_type,
-                            "source": {
-                                "type": "file",
-                                "file_id": file_id
-                            }
-                        }
-                    ]
-                }
-            ],
-            output_config={
-                "format": OCR_TEXT_FORMAT
-            }
-            ,
-            betas=["files-api-2025-04-14"]
+    if result["success"]:
+        with metrics.span("/extract_user_details", "cache_store"):
+            await asyncio.to_thread(
+                content_cache.get_result_cache().put, content_key, "ocr", OCR_CACHE_VERSION, result
+            )
+    return result
+
+
+async def extract_text(file_id: str, mime_type: str, page_count: int | None = None) -> dict:
+    """
+    OCR result ({"success", "data"}) for a file: the cached transcription of
+    its content, the OCR call already running for it, or a new one.
+    """
+    with metrics.span("/extract_user_details", "cache_lookup"):
+        content_key = await content_cache.content_key_for(file_id)
+        cached = await asyncio.to_thread(
+            content_cache.get_result_cache().get, content_key, "ocr", OCR_CACHE_VERSION
+        )
+    if cached is not None:
+        return cached
+
+    if mime_type == "application/pdf" and page_count is None:
+        page_count = await asyncio.to_thread(content_cache.get_file_index().page_count_for, file_id)
+    if mime_type == "application/pdf" and page_count and page_count > OCR_MAX_PDF_PAGES:
+        raise PdfTooLong(
+            f"The PDF has {page_count} pages; at most {OCR_MAX_PDF_PAGES} pages can be processed "
+            "per document. Split it into smaller files and upload them separately."
         )
 
-        ai_reply = response.content[0].text
-        ai_reply = re.sub(r'^```json\s*', '', ai_reply)
-        ai_reply = re.sub(r'^```\s*', '', ai_reply)
-        ai_reply = re.sub(r'\s*```$', '', ai_reply)
-        ai_reply = ai_reply.strip()
+    return await ocr_inflight.do(
+        (content_key, mime_type, page_count),
+        lambda: ocr_document(file_id, content_key, mime_type, page_count),
+    )
+
+
+async def stored_text(content_key: str) -> str | None:
+    """Text of an earlier successful OCR of this content, or None."""
+    cached = await asyncio.to_thread(
+        content_cache.get_result_cache().get, content_key, "ocr", OCR_CACHE_VERSION
+    )
+    if cached is None or not cached.get("success") or not cached.get("data", "").strip():
+        return None
+    return cached["data"]
 
-        response_json = json.loads(ai_reply)
-        data = response_json.get("data", "")
-        success = response_json.get("success", {})
+
+@router.post("/extract_user_details")
+async def extract_user_details(file_id: str, mime_type: str, page_count: int | None = None):
+    """
+    file_id: OpenAI uploaded file ID (from another API)
+    page_count: number of pages of a PDF; defaults to the count recorded at
+    upload. PDFs longer than OCR_CHUNK_PAGES are OCRed in parallel page
+    ranges; PDFs longer than OCR_MAX_PDF_PAGES are rejected with 413.
+    """
+    try:
+        result = await extract_text(file_id, mime_type, page_count)
+        data = result["data"]
+        success = result["success"]
 
         return {
             "response": {
@@ -107,8 +302,17 @@ async def extract_user_details(file_id: str, mime_type: str):
             }
         }
 
+    except PdfTooLong as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(
-            status_code=500,
+            status_code=resilience.error_status(e),
             detail=f"OCR processing failed: {str(e)}"
         )
+
+
+# Standalone app, kept for deployments that still run `uvicorn ocr:app`
+app = FastAPI(title="GpsLaw.AI OCR API", lifespan=clients.lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(router)
+app.include_router(metrics.router)
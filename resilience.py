@@ -0,0 +1,164 @@
+"""
+Protection for upstream model calls: identical concurrent requests share
+one call (SingleFlight), transient API errors are retried with jittered
+exponential backoff under a process-wide retry budget, and slow calls can
+be hedged with a second identical request.
+"""
+import asyncio
+import random
+
+import admission
+import metrics
+from config import env_vars
+
+# Attempts per call, including the first
+RETRY_MAX_ATTEMPTS = int(env_vars.get("RETRY_MAX_ATTEMPTS") or 3)
+RETRY_BASE_DELAY = float(env_vars.get("RETRY_BASE_DELAY") or 0.5)
+RETRY_MAX_DELAY = float(env_vars.get("RETRY_MAX_DELAY") or 8)
+# Retries (and hedges) earned per successful call, and the most that can be saved up
+RETRY_BUDGET_RATIO = float(env_vars.get("RETRY_BUDGET_RATIO") or 0.2)
+RETRY_BUDGET_MAX = float(env_vars.get("RETRY_BUDGET_MAX") or 20)
+
+UPSTREAM_EVENTS = metrics.Counter(
+    "gpslaw_upstream_events_total",
+    "Upstream model calls coalesced, retried, refused a retry by the budget, hedged, or won by the hedge.",
+    ("endpoint", "event"),
+)
+
+
+class RetryBudget:
+    """
+    Token bucket shared by all calls: each success adds `ratio` tokens up
+    to `max_tokens`, each retry or hedge spends one. During an outage the
+    bucket drains and calls fail fast instead of multiplying the load.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Connection errors, timeouts, 408, 409, 429 and 5xx (incl. 529 overloaded), as the SDK itself retries."""
+    # Only SDK errors qualify, and raising one means the SDK is already imported
+    import anthropic
+
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def error_status(error: Exception) -> int:
+    """HTTP status for a failed request: 503 when the upstream error was transient or no capacity was free, else 500."""
+    return 503 if isinstance(error, admission.Overloaded) or is_retryable(error) else 500
+
+
+def backoff_delay(error: Exception, attempt: int) -> float:
+    """Full-jitter exponential backoff, but at least what a retry-after header asks for."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = max(delay, min(float(retry_after), RETRY_MAX_DELAY))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+async def call(fn, endpoint: str, hedge_after: float = 0):
+    """
+    Await `fn()`, a coroutine function making one upstream call, retrying
+    transient errors. Use a client without SDK retries
+    (clients.get_unretried_client) so retries are not multiplied. With
+    `hedge_after` > 0, an attempt still running after that many seconds is
+    raced against a second identical call.
+    """
+    attempt = 0
+    while True:
+        try:
+            result = await (hedged(fn, endpoint, hedge_after) if hedge_after > 0 else fn())
+        except Exception as e:
+            attempt += 1
+            if attempt >= RETRY_MAX_ATTEMPTS or not is_retryable(e):
+                raise
+            if not retry_budget.withdraw():
+                UPSTREAM_EVENTS.inc(endpoint=endpoint, event="retry_budget_exhausted")
+                raise
+            UPSTREAM_EVENTS.inc(endpoint=endpoint, event="retry")
+            print(f"{endpoint}: retrying after {type(e).__name__} (attempt {attempt + 1})")
+            await asyncio.sleep(backoff_delay(e, attempt - 1))
+            continue
+        retry_budget.deposit()
+        return result
+
+
+async def hedged(fn, endpoint: str, delay: float):
+    """First successful result of `fn()` and, if it is slower than `delay`, a second `fn()`."""
+    primary = asyncio.ensure_future(fn())
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not retry_budget.withdraw():
+            return await primary
+
+        UPSTREAM_EVENTS.inc(endpoint=endpoint, event="hedge")
+        hedge = asyncio.ensure_future(fn())
+        tasks.add(hedge)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        UPSTREAM_EVENTS.inc(endpoint=endpoint, event="hedge_won")
+                    return task.result()
+        # Both failed: report the primary's error
+        return primary.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class SingleFlight:
+    """
+    Identical concurrent requests (same key) share one execution: the
+    first caller starts it, later callers await the same result. Only
+    calls in flight are shared; nothing is kept once the call finishes.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            UPSTREAM_EVENTS.inc(endpoint=self.endpoint, event="coalesced")
+        # A caller that disconnects must not cancel the call others are waiting on
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the error as retrieved even if every caller has gone away
+            task.exception()
@@ -0,0 +1,255 @@
+"""
+Decoding of structured model replies shared by all endpoints: strip an
+optional markdown fence, then parse and validate the JSON in one pass
+against a pydantic model built from the endpoint's output format.
+"""
+import re
+
+import jiter
+from pydantic import BaseModel, ConfigDict, ValidationError, create_model
+
+
+class ResponseDecodeError(ValueError):
+    """The model reply is not valid JSON for the expected output format."""
+
+
+def strip_fences(text: str) -> str:
+    """Remove a surrounding ```json ... ``` fence, if any, without regex backtracking."""
+    start = 0
+    end = len(text)
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if text.startswith("```", start):
+        start += 3
+        if text.startswith("json", start):
+            start += 4
+        if text.endswith("```", start, end):
+            end -= 3
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+    return text[start:end]
+
+
+class _Lenient(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+
+def _field_type(schema: dict, name: str):
+    kind = schema.get("type")
+    if kind == "object":
+        model = _object_model(name, schema)
+        return model, model()
+    if kind == "array":
+        item_type, _ = _field_type(schema.get("items", {}), name + "Item")
+        return list[item_type], []
+    if kind == "string":
+        return str, ""
+    if kind == "boolean":
+        return bool, False
+    if kind in ("integer", "number"):
+        return (int if kind == "integer" else float), 0
+    return object, None
+
+
+def _object_model(name: str, schema: dict) -> type[BaseModel]:
+    fields = {}
+    for field, field_schema in schema.get("properties", {}).items():
+        field_type, default = _field_type(field_schema, name + field.title().replace("_", ""))
+        fields[field] = (field_type, default)
+    return create_model(name, __base__=_Lenient, **fields)
+
+
+def response_model(name: str, output_format: dict) -> type[BaseModel]:
+    """
+    Pydantic model for a json_schema output format (TEXT_FORMAT,
+    OCR_TEXT_FORMAT, ...). Every field is optional with an empty default,
+    matching how the endpoints treated missing keys; nested objects the
+    model left empty (e.g. legal_guidance during questioning) stay empty.
+    Build it once at import time and reuse it.
+    """
+    return _object_model(name, output_format["schema"])
+
+
+def decode_response(text: str, model: type[BaseModel]) -> dict:
+    """
+    Parse a model reply with jiter and validate it against `model`.
+    Returns only the keys the model actually produced, so callers keep
+    their `.get(key, default)`.
+    """
+    try:
+        data = jiter.from_json(strip_fences(text).encode())
+    except ValueError as e:
+        raise ResponseDecodeError(f"Model response is not valid JSON: {e}") from e
+    try:
+        return model.model_validate(data).model_dump(exclude_unset=True)
+    except ValidationError as e:
+        raise ResponseDecodeError(f"Model response does not match the output format: {e}") from e
+
+
+class PartialReplyParser:
+    """
+    Incrementally parses a streamed JSON reply. `stream_field` is reported
+    as it grows; the other top-level fields are reported once complete,
+    i.e. once the model has moved on to the next key.
+
+    Each delta is scanned once: the parser keeps its place in the
+    top-level object (string and nesting state, where the current key and
+    value started) and holds on only to the text it may still have to
+    decode, so a reply costs linear time however finely it is split.
+    """
+
+    def __init__(self, stream_field: str = "message"):
+        self.stream_field = stream_field
+        self.fields_sent = set()
+        self._chunks = []
+        # Unscanned text and the text still to decode; positions below index into it
+        self._buf = ""
+        self._pos = 0
+        self._started = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        # What the top-level object expects next: "key", "colon", "value" or "in_value"
+        self._expect = "key"
+        self._key_start = 0
+        self._key = None
+        self._value_start = 0
+        # Start of the part of the stream_field string not yet reported, while inside it
+        self._stream_from = None
+
+    @property
+    def text(self) -> str:
+        """The reply received so far."""
+        return "".join(self._chunks)
+
+    def feed(self, delta: str) -> list[tuple[str, object]]:
+        self._chunks.append(delta)
+        events = []
+        if self._done:
+            return events
+        self._buf += delta
+        if not (self._started or self._find_start()):
+            return events
+        buf = self._buf
+        i = self._pos
+        while i < len(buf) and not self._done:
+            if self._in_string:
+                match = _STRING_STOP.search(buf, i)
+                if match is None:
+                    i = len(buf)
+                    break
+                i = match.end()
+                if match.group() == "\\":
+                    # Skip the escaped character, which may be in the next delta
+                    i += 1
+                    continue
+                self._in_string = False
+                if self._depth == 1:
+                    if self._expect == "key":
+                        self._key = _loads(buf[self._key_start:i])
+                        self._expect = "colon"
+                    elif self._stream_from is not None:
+                        self._emit_stream(events, i - 1, final=True)
+                        self._stream_from = None
+                continue
+
+            char = buf[i]
+            if self._depth == 1 and self._expect == "value" and not char.isspace():
+                self._value_start = i
+                self._expect = "in_value"
+                if char == '"' and self._key == self.stream_field:
+                    self._stream_from = i + 1
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect == "key":
+                    self._key_start = i
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                # The last field is left to the caller's final decode, as it may still be cut short
+                self._done = self._depth == 0
+            elif self._depth == 1 and char == ":" and self._expect == "colon":
+                self._expect = "value"
+            elif self._depth == 1 and char == ",":
+                if self._expect == "in_value" and self._key != self.stream_field and self._key not in self.fields_sent:
+                    value = _loads(buf[self._value_start:i])
+                    if value is not _INVALID:
+                        self.fields_sent.add(self._key)
+                        events.append((self._key, value))
+                self._expect = "key"
+            i += 1
+        self._pos = i
+
+        if self._stream_from is not None:
+            self._emit_stream(events, len(buf), final=False)
+        self._trim()
+        return events
+
+    def _find_start(self) -> bool:
+        """Position the scan after the opening brace, past an optional ```json fence."""
+        body = self._buf.lstrip()
+        if body.startswith("```"):
+            brace = self._buf.find("{")
+        elif body.startswith("{"):
+            brace = len(self._buf) - len(body)
+        else:
+            # Not JSON once it is more than the start of a fence
+            self._done = not "```".startswith(body[:3])
+            return False
+        if brace < 0:
+            return False
+        self._started = True
+        self._pos = brace + 1
+        self._depth = 1
+        return True
+
+    def _emit_stream(self, events: list, end: int, final: bool) -> None:
+        """Report the stream_field text up to `end`, holding back an escape that may continue in the next delta."""
+        raw = self._buf[self._stream_from:end]
+        if not final:
+            # \uXXXX\uXXXX (a surrogate pair) is the longest escape
+            cut = raw.find("\\", max(0, len(raw) - 12))
+            if cut >= 0:
+                while cut > 0 and raw[cut - 1] == "\\":
+                    cut -= 1
+                raw = raw[:cut]
+        if not raw:
+            return
+        value = _loads(f'"{raw}"')
+        if value is _INVALID:
+            return
+        self._stream_from += len(raw)
+        events.append((self.stream_field, {"delta": value}))
+
+    def _trim(self) -> None:
+        """Drop the scanned text that no pending key, field value or stream delta needs."""
+        keep = min(self._pos, len(self._buf))
+        if self._in_string and self._depth == 1 and self._expect == "key":
+            keep = min(keep, self._key_start)
+        if self._expect == "in_value" and self._key != self.stream_field:
+            keep = min(keep, self._value_start)
+        if self._stream_from is not None:
+            keep = min(keep, self._stream_from)
+        if keep:
+            self._buf = self._buf[keep:]
+            self._pos -= keep
+            self._key_start -= keep
+            self._value_start -= keep
+            if self._stream_from is not None:
+                self._stream_from -= keep
+
+
+_STRING_STOP = re.compile(r'["\\]')
+_INVALID = object()
+
+
+def _loads(text: str):
+    try:
+        return jiter.from_json(text.encode())
+    except ValueError:
+        return _INVALID
@@ -0,0 +1,156 @@
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from session_store import SessionConflict, SessionStore
+
+
+class CachedSessionStore(SessionStore):
+    """
+    Bounded in-memory LRU cache of hot sessions in front of another
+    SessionStore. Writes go through to the backing store immediately, so
+    the cache never holds unsaved turns and can be dropped at any time.
+
+    Hits are served without touching the backing store. If other workers
+    append to the same sessions, a stale copy is caught by the
+    optimistic append (SessionConflict, and the entry is dropped); with
+    `revalidate` set, each hit is also checked against the backing
+    store's turn count (one indexed lookup) and reloaded when the session
+    has grown, so a turn starts from the current history rather than
+    failing its append after the model call. Entries also expire after
+    `ttl` seconds, and the least recently used sessions are evicted once
+    either `max_sessions` or the approximate `max_bytes` cap is exceeded.
+    """
+
+    def __init__(self, backend: SessionStore, max_sessions: int = 1000,
+                 ttl: float = 300, max_bytes: int = 64 * 1024 * 1024, revalidate: bool = False):
+        self.backend = backend
+        self.revalidate = revalidate
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # session_id -> [turns, approximate size in bytes, loaded_at]
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+
+    def get(self, session_id):
+        with self._lock:
+            cached = self._entries.get(session_id)
+            if cached is not None and monotonic() - cached[2] >= self.ttl:
+                self._drop(session_id)
+                self.expirations += 1
+                cached = None
+            turns = list(cached[0]) if cached is not None else None
+
+        if turns is not None:
+            if not self.revalidate or self.backend.turn_count(session_id) == len(turns):
+                with self._lock:
+                    if session_id in self._entries:
+                        self._entries.move_to_end(session_id)
+                    self.hits += 1
+                return turns
+            # Another worker appended to this session: reload it
+            with self._lock:
+                self._drop(session_id)
+                self.stale += 1
+
+        with self._lock:
+            self.misses += 1
+
+        turns = self.backend.get(session_id)
+        if turns is not None:
+            with self._lock:
+                self._put(session_id, list(turns))
+        return turns
+
+    def create(self, session_id, user_name=None):
+        self.backend.create(session_id, user_name)
+        with self._lock:
+            if session_id not in self._entries:
+                self._put(session_id, [])
+
+    def append(self, session_id, entry, expected_turns=None):
+        try:
+            self.backend.append(session_id, entry, expected_turns)
+        except SessionConflict:
+            # Our copy is stale: another worker appended to this session
+            self.invalidate(session_id)
+            raise
+        with self._lock:
+            cached = self._entries.get(session_id)
+            if cached is not None:
+                size = _entry_size(entry)
+                cached[0].append(entry)
+                cached[1] += size
+                self._bytes += size
+                self._entries.move_to_end(session_id)
+                self._evict()
+
+    def import_session(self, session_id, entries):
+        self.backend.import_session(session_id, entries)
+        self.invalidate(session_id)
+
+    def list_sessions(self, user_name=None, country=None, legal_domain=None, limit=50, cursor=None):
+        return self.backend.list_sessions(user_name, country, legal_domain, limit, cursor)
+
+    def get_turns(self, session_id, cursor=0, limit=20):
+        # Pages are read from the backing store, which has every worker's appends
+        return self.backend.get_turns(session_id, cursor, limit)
+
+    def archive_idle(self, idle_seconds):
+        # Archiving does not change a session's turns, so cached copies stay valid
+        return self.backend.archive_idle(idle_seconds)
+
+    def invalidate(self, session_id: str) -> None:
+        """Forget a cached session so the next read goes to the backing store."""
+        with self._lock:
+            self._drop(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale": self.stale,
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        self.backend.close()
+
+    def _put(self, session_id, turns):
+        self._drop(session_id)
+        size = sum(_entry_size(entry) for entry in turns)
+        self._entries[session_id] = [turns, size, monotonic()]
+        self._bytes += size
+        self._evict()
+
+    def _drop(self, session_id):
+        cached = self._entries.pop(session_id, None)
+        if cached is not None:
+            self._bytes -= cached[1]
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_sessions or self._bytes > self.max_bytes
+        ):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+
+def _entry_size(entry: dict) -> int:
+    return len(json.dumps(entry))
@@ -0,0 +1,581 @@
+import json
+import os
+import sys
+import zlib
+from time import time
+
+import legal_context
+from db import SqliteDatabase
+
+SESSIONS_DB = "chat_sessions.db"
+LEGACY_SESSIONS_FILE = "chat_sessions.json"
+# Recorded in the store once the legacy JSON file has been imported
+LEGACY_IMPORT_MARKER = "legacy_json_import"
+# Recorded once the country / legal_domain columns hold lookup keys
+LOOKUP_KEYS_MARKER = "normalized_lookup_columns"
+
+# A stored turn whose localization equals the previous turn's holds this
+# marker instead of repeating the object (it rarely changes after Phase 1)
+SAME_LOCALIZATION = "="
+
+
+class SessionConflict(Exception):
+    """The session gained turns since it was read, e.g. from a concurrent request on another worker."""
+
+
+class SessionStore:
+    """
+    Chat session persistence. Backends only ever read or append the one
+    session being handled, so per-turn I/O does not grow with the number
+    of stored sessions.
+    """
+
+    def get(self, session_id: str) -> list | None:
+        """Return the turns of a session, or None if it does not exist."""
+        raise NotImplementedError
+
+    def turn_count(self, session_id: str) -> int | None:
+        """Number of turns of a session, or None if it does not exist."""
+        turns = self.get(session_id)
+        return None if turns is None else len(turns)
+
+    def create(self, session_id: str, user_name: str | None = None) -> None:
+        """Create an empty session. Creating an existing session is a no-op."""
+        raise NotImplementedError
+
+    def append(self, session_id: str, entry: dict, expected_turns: int | None = None) -> None:
+        """
+        Append one turn to the end of a session. With `expected_turns`,
+        the append only succeeds if the session still has exactly that many
+        turns, otherwise SessionConflict is raised and nothing is written.
+        """
+        raise NotImplementedError
+
+    def import_session(self, session_id: str, entries: list) -> None:
+        """Create a session with all of its turns (used by the migrator)."""
+        self.create(session_id)
+        for entry in entries:
+            self.append(session_id, entry)
+
+    def is_imported(self, marker: str) -> bool:
+        """Whether import_sessions has completed for `marker`."""
+        return False
+
+    def import_sessions(self, sessions: dict, marker: str) -> int | None:
+        """
+        Import {session_id: turns}, leaving sessions already in the store
+        untouched, and record `marker`. Returns the number of sessions
+        imported, or None if `marker` was already recorded.
+        """
+        imported = 0
+        for session_id, entries in sessions.items():
+            if self.get(session_id) is not None:
+                continue
+            self.import_session(session_id, entries)
+            imported += 1
+        return imported
+
+    def list_sessions(self, user_name: str | None = None, country: str | None = None,
+                      legal_domain: str | None = None, limit: int = 50,
+                      cursor: str | None = None) -> tuple[list[dict], str | None]:
+        """
+        One page of sessions, most recently active first, optionally
+        filtered by user name (case-insensitive) and by the country / legal
+        domain of their latest localization. Those are free text from the
+        model, so they are stored as legal_context.lookup_key words and
+        match on leading whole words: legal_domain="employment" finds
+        "Employment law" and "Employment / Unpaid wages". Returns (sessions,
+        next_cursor); pass next_cursor back for the following page, it is
+        None on the last one. Raises ValueError for a malformed cursor.
+        """
+        raise NotImplementedError
+
+    def get_turns(self, session_id: str, cursor: int = 0, limit: int = 20) -> tuple[list, int | None] | None:
+        """
+        Turns `cursor` to `cursor + limit - 1` of a session and the cursor
+        of the next page (None on the last one), or None if the session
+        does not exist.
+        """
+        turns = self.get(session_id)
+        if turns is None:
+            return None
+        end = cursor + limit
+        return turns[cursor:end], end if end < len(turns) else None
+
+    def archive_idle(self, idle_seconds: float) -> int:
+        """
+        Move sessions without a new turn for `idle_seconds` to cold storage
+        and return how many were moved. Archived sessions stay readable and
+        are restored by their next append.
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+def encode_turns(entries: list, previous_localization=None) -> list[str]:
+    """
+    Compact JSON rows for consecutive turns, the first following a turn
+    with `previous_localization`. Unchanged localizations become SAME_LOCALIZATION.
+    """
+    rows = []
+    for entry in entries:
+        localization = entry.get("localization")
+        if localization is not None and localization == previous_localization:
+            entry = {**entry, "localization": SAME_LOCALIZATION}
+        previous_localization = localization
+        rows.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+    return rows
+
+
+def decode_turns(rows, previous_localization=None) -> list:
+    """
+    Turns from encode_turns rows (or older rows that repeat every
+    localization); `previous_localization` is that of the turn before the first row.
+    """
+    entries = []
+    for row in rows:
+        entry = json.loads(row)
+        if entry.get("localization") == SAME_LOCALIZATION:
+            entry["localization"] = previous_localization
+        previous_localization = entry.get("localization")
+        entries.append(entry)
+    return entries
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite backend in WAL mode: one row per turn, keyed by
+    (session_id, seq). Appends are single-row inserts in their own
+    transaction, so concurrent turns from several workers never rewrite
+    each other's data and a crash never leaves a half-written session.
+    The turn count doubles as the session version for optimistic appends.
+
+    Rows are encode_turns JSON; `sessions` keeps the last turn's
+    localization to encode the next append against. Idle sessions are
+    archived as one zlib-compressed row in `archived_sessions`.
+
+    `sessions` also records the user name, creation and last-activity
+    times and the country / legal domain of the latest localization
+    (normalized with legal_context.lookup_key), indexed for list_sessions.
+    """
+
+    def __init__(self, path: str = SESSIONS_DB):
+        self.db = SqliteDatabase(path)
+        conn = self.db.connect()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                user_name TEXT COLLATE NOCASE,
+                created_at REAL,
+                updated_at REAL,
+                localization TEXT,
+                country TEXT COLLATE NOCASE,
+                legal_domain TEXT COLLATE NOCASE
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS archived_sessions (
+                session_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS markers (
+                name TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+            """
+        )
+        if not {"updated_at", "user_name"} <= self._session_columns(conn):
+            self._upgrade(conn)
+        if not self.is_imported(LOOKUP_KEYS_MARKER):
+            self._normalize_lookup_columns(conn)
+        conn.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            CREATE INDEX IF NOT EXISTS sessions_user
+                ON sessions (user_name, updated_at);
+            CREATE INDEX IF NOT EXISTS sessions_country_domain
+                ON sessions (country, legal_domain, updated_at);
+            """
+        )
+
+    @staticmethod
+    def _session_columns(conn) -> set[str]:
+        return {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+
+    def _upgrade(self, conn):
+        """
+        Add the columns missing from a database created by an older
+        version. Runs in one write transaction and re-checks the columns
+        inside it, so workers opening the database together upgrade it once.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = self._session_columns(conn)
+            if "updated_at" not in columns:
+                # Created before idle sessions were archived: existing sessions
+                # start aging now, and their rows keep full localizations
+                conn.execute("ALTER TABLE sessions ADD COLUMN updated_at REAL")
+                conn.execute("ALTER TABLE sessions ADD COLUMN localization TEXT")
+                conn.execute("UPDATE sessions SET updated_at = ?", (time(),))
+            if "user_name" not in columns:
+                # Created before sessions were indexed: the user name is unknown,
+                # the creation time is taken to be the last activity
+                conn.execute("ALTER TABLE sessions ADD COLUMN user_name TEXT COLLATE NOCASE")
+                conn.execute("ALTER TABLE sessions ADD COLUMN created_at REAL")
+                conn.execute("ALTER TABLE sessions ADD COLUMN country TEXT COLLATE NOCASE")
+                conn.execute("ALTER TABLE sessions ADD COLUMN legal_domain TEXT COLLATE NOCASE")
+                conn.execute("UPDATE sessions SET created_at = updated_at")
+                updates = []
+                for (session_id,) in conn.execute("SELECT session_id FROM sessions").fetchall():
+                    localization = _latest_localization(self._read_turns(conn, session_id) or [])
+                    if localization:
+                        updates.append((*_index_fields(localization), session_id))
+                conn.executemany(
+                    "UPDATE sessions SET country = ?, legal_domain = ? WHERE session_id = ?", updates
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _normalize_lookup_columns(self, conn):
+        """
+        Rewrite country / legal_domain values stored verbatim by an older
+        version as lookup keys. Runs once per database, guarded by a
+        marker like the legacy import.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM markers WHERE name = ?", (LOOKUP_KEYS_MARKER,)).fetchone():
+                rows = conn.execute(
+                    "SELECT session_id, country, legal_domain FROM sessions "
+                    "WHERE country IS NOT NULL OR legal_domain IS NOT NULL"
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE sessions SET country = ?, legal_domain = ? WHERE session_id = ?",
+                    [(legal_context.lookup_key(country), legal_context.lookup_key(legal_domain), session_id)
+                     for session_id, country, legal_domain in rows],
+                )
+                conn.execute("INSERT INTO markers (name) VALUES (?)", (LOOKUP_KEYS_MARKER,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _read_turns(self, conn, session_id):
+        """get() inside the caller's transaction."""
+        rows = conn.execute(
+            "SELECT data FROM turns WHERE session_id = ? ORDER BY seq",
+            (session_id,),
+        ).fetchall()
+        if rows:
+            return decode_turns(data for (data,) in rows)
+        archived = conn.execute(
+            "SELECT data FROM archived_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if archived:
+            return decode_turns(_unpack(archived[0]))
+        exists = conn.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return [] if exists else None
+
+    def get(self, session_id):
+        conn = self.db.connect()
+        # One read snapshot, so a session being archived or restored is seen in one place
+        conn.execute("BEGIN")
+        try:
+            return self._read_turns(conn, session_id)
+        finally:
+            conn.execute("COMMIT")
+
+    def turn_count(self, session_id):
+        conn = self.db.connect()
+        conn.execute("BEGIN")
+        try:
+            (count,) = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if count:
+                return count
+            archived = conn.execute(
+                "SELECT data FROM archived_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if archived:
+                return len(_unpack(archived[0]))
+            exists = conn.execute(
+                "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            return 0 if exists else None
+        finally:
+            conn.execute("COMMIT")
+
+    def create(self, session_id, user_name=None):
+        now = time()
+        self.db.connect().execute(
+            "INSERT OR IGNORE INTO sessions (session_id, user_name, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (session_id, user_name, now, now),
+        )
+
+    def list_sessions(self, user_name=None, country=None, legal_domain=None, limit=50, cursor=None):
+        where = []
+        args = []
+        if user_name is not None:
+            where.append("user_name = ?")
+            args.append(user_name)
+        for column, value in (("country", country), ("legal_domain", legal_domain)):
+            if value is not None:
+                # The key itself or the key followed by more words: after
+                # normalization only " " sorts below "!", so this is one index range
+                key = legal_context.lookup_key(value) or ""
+                where.append(f"{column} >= ? AND {column} < ?")
+                args.extend((key, key + "!"))
+        if cursor is not None:
+            # Keyset pagination: sessions after the last one of the previous page
+            updated_at, session_id = _parse_cursor(cursor)
+            where.append("(updated_at < ? OR (updated_at = ? AND session_id < ?))")
+            args.extend((updated_at, updated_at, session_id))
+        rows = self.db.connect().execute(
+            "SELECT session_id, user_name, created_at, updated_at, country, legal_domain FROM sessions"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY updated_at DESC, session_id DESC LIMIT ?",
+            (*args, limit + 1),
+        ).fetchall()
+        sessions = [
+            {
+                "session_id": session_id,
+                "user_name": name,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "country": country,
+                "legal_domain": legal_domain,
+            }
+            for session_id, name, created_at, updated_at, country, legal_domain in rows[:limit]
+        ]
+        if len(rows) <= limit:
+            return sessions, None
+        last = sessions[-1]
+        return sessions, f"{last['updated_at']!r}|{last['session_id']}"
+
+    def get_turns(self, session_id, cursor=0, limit=20):
+        conn = self.db.connect()
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute(
+                "SELECT seq, data FROM turns WHERE session_id = ? AND seq >= ? ORDER BY seq LIMIT ?",
+                (session_id, cursor, limit + 1),
+            ).fetchall()
+            previous = None
+            if rows and json.loads(rows[0][1]).get("localization") == SAME_LOCALIZATION:
+                previous = self._localization_before(conn, session_id, rows[0][0])
+        finally:
+            conn.execute("COMMIT")
+        if not rows:
+            # Past the end, archived, empty or missing: read the whole session
+            return super().get_turns(session_id, cursor, limit)
+        turns = decode_turns((data for _, data in rows[:limit]), previous)
+        return turns, cursor + limit if len(rows) > limit else None
+
+    def _localization_before(self, conn, session_id, seq):
+        """The localization in effect before turn `seq`: the closest earlier one written out in full."""
+        for (data,) in conn.execute(
+            "SELECT data FROM turns WHERE session_id = ? AND seq < ? ORDER BY seq DESC",
+            (session_id, seq),
+        ):
+            localization = json.loads(data).get("localization")
+            if localization != SAME_LOCALIZATION:
+                return localization
+        return None
+
+    def append(self, session_id, entry, expected_turns=None):
+        self._insert_turns(session_id, [entry], expected_turns)
+
+    def import_session(self, session_id, entries):
+        self._insert_turns(session_id, entries)
+
+    def is_imported(self, marker):
+        return self.db.connect().execute(
+            "SELECT 1 FROM markers WHERE name = ?", (marker,)
+        ).fetchone() is not None
+
+    def import_sessions(self, sessions, marker):
+        # One transaction for the whole import: workers starting together
+        # import once, and an interrupted import leaves no marker and no sessions
+        conn = self.db.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM markers WHERE name = ?", (marker,)).fetchone():
+                conn.execute("COMMIT")
+                return None
+            imported = 0
+            for session_id, entries in sessions.items():
+                if conn.execute(
+                    "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone():
+                    continue
+                self._write_turns(conn, session_id, entries)
+                imported += 1
+            conn.execute("INSERT INTO markers (name) VALUES (?)", (marker,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return imported
+
+    def _insert_turns(self, session_id, entries, expected_turns=None):
+        conn = self.db.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_turns(conn, session_id, entries, expected_turns)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _write_turns(self, conn, session_id, entries, expected_turns=None):
+        """Append turns inside the caller's write transaction."""
+        now = time()
+        conn.execute(
+            "INSERT OR IGNORE INTO sessions (session_id, created_at, updated_at) VALUES (?, ?, ?)",
+            (session_id, now, now),
+        )
+        self._restore(conn, session_id)
+        (next_seq,) = conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        if expected_turns is not None and next_seq != expected_turns:
+            raise SessionConflict(
+                f"Session {session_id} has {next_seq} turns, expected {expected_turns}"
+            )
+        (previous,) = conn.execute(
+            "SELECT localization FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        rows = encode_turns(entries, json.loads(previous) if previous else None)
+        conn.executemany(
+            "INSERT INTO turns (session_id, seq, data) VALUES (?, ?, ?)",
+            [(session_id, next_seq + i, row) for i, row in enumerate(rows)],
+        )
+        if entries:
+            localization = entries[-1].get("localization")
+            # The lookup columns keep the latest localization, even past turns without one
+            country, legal_domain = _index_fields(_latest_localization(entries))
+            conn.execute(
+                "UPDATE sessions SET updated_at = ?, localization = ?, "
+                "country = COALESCE(?, country), legal_domain = COALESCE(?, legal_domain) "
+                "WHERE session_id = ?",
+                (now, json.dumps(localization) if localization is not None else None,
+                 country, legal_domain, session_id),
+            )
+
+    def _restore(self, conn, session_id):
+        """Move an archived session back to `turns` (inside the caller's transaction)."""
+        archived = conn.execute(
+            "SELECT data FROM archived_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if archived is None:
+            return
+        conn.executemany(
+            "INSERT INTO turns (session_id, seq, data) VALUES (?, ?, ?)",
+            [(session_id, seq, row) for seq, row in enumerate(_unpack(archived[0]))],
+        )
+        conn.execute("DELETE FROM archived_sessions WHERE session_id = ?", (session_id,))
+
+    def archive_idle(self, idle_seconds):
+        cutoff = time() - idle_seconds
+        conn = self.db.connect()
+        candidates = conn.execute(
+            "SELECT session_id FROM sessions WHERE updated_at < ? "
+            "AND EXISTS (SELECT 1 FROM turns WHERE turns.session_id = sessions.session_id)",
+            (cutoff,),
+        ).fetchall()
+        archived = 0
+        # One short transaction per session, so appends are never blocked for long
+        for (session_id,) in candidates:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                still_idle = conn.execute(
+                    "SELECT 1 FROM sessions WHERE session_id = ? AND updated_at < ?",
+                    (session_id, cutoff),
+                ).fetchone()
+                rows = conn.execute(
+                    "SELECT data FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)
+                ).fetchall()
+                if still_idle and rows:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO archived_sessions (session_id, data) VALUES (?, ?)",
+                        (session_id, _pack([data for (data,) in rows])),
+                    )
+                    conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                    archived += 1
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return archived
+
+    def close(self):
+        self.db.close()
+
+
+def _latest_localization(entries: list) -> dict | None:
+    return next((entry["localization"] for entry in reversed(entries) if entry.get("localization")), None)
+
+
+def _index_fields(localization: dict | None) -> tuple[str | None, str | None]:
+    """(country, legal_domain) lookup keys for the session lookup columns; unknown values are NULL."""
+    if not localization:
+        return None, None
+    return (legal_context.lookup_key(localization.get("country")),
+            legal_context.lookup_key(localization.get("legal_domain")))
+
+
+def _parse_cursor(cursor: str) -> tuple[float, str]:
+    updated_at, separator, session_id = cursor.partition("|")
+    if not separator:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return float(updated_at), session_id
+
+
+def _pack(rows: list[str]) -> bytes:
+    """One zlib-compressed JSON array of a session's encoded turn rows."""
+    return zlib.compress(("[" + ",".join(rows) + "]").encode(), 9)
+
+
+def _unpack(data: bytes) -> list[str]:
+    return [
+        json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        for entry in json.loads(zlib.decompress(data))
+    ]
+
+
+def migrate_json_sessions(store: SessionStore, json_path: str = LEGACY_SESSIONS_FILE) -> int:
+    """
+    One-shot import of the legacy chat_sessions.json file
+    ({session_id: [turn, ...]}) into a SessionStore.
+    Sessions already present in the store are left untouched.
+    Returns the number of sessions imported (0 once the import has run).
+    A failed import records nothing and is attempted again next time.
+    """
+    if store.is_imported(LEGACY_IMPORT_MARKER):
+        return 0
+    with open(json_path, "r") as f:
+        sessions = json.load(f)
+    return store.import_sessions(sessions, LEGACY_IMPORT_MARKER) or 0
+
+
+if __name__ == "__main__":
+    # python session_store.py [chat_sessions.json] [chat_sessions.db]
+    json_path = sys.argv[1] if len(sys.argv) > 1 else LEGACY_SESSIONS_FILE
+    db_path = sys.argv[2] if len(sys.argv) > 2 else SESSIONS_DB
+    if not os.path.exists(json_path):
+        sys.exit(f"{json_path} not found")
+    count = migrate_json_sessions(SqliteSessionStore(db_path), json_path)
+    print(f"Imported {count} sessions from {json_path} into {db_path}")
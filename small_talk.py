@@ -0,0 +1,77 @@
+"""
+Rule-based detection of small talk that needs no model call: a message
+that is only a greeting, or only asks who the assistant is. Anything
+else, including a greeting followed by a legal question, goes to the model.
+"""
+import random
+import re
+
+GREETING = (
+    r"(hi|hello|hey|hiya|howdy|greetings|good (morning|afternoon|evening|day)"
+    r"|bonjour|bonsoir|salut|coucou|hola|buenos dias|hallo|ciao)"
+    r"( there| all| everyone| gpslaw( ?ai)?)?"
+)
+IDENTITY = (
+    r"(who|what) are you|who am i (talking|speaking) (to|with)|what (can|do) you do"
+    r"|what is (this|gpslaw( ?ai)?)|tell me about yourself|introduce yourself|are you a (bot|robot|lawyer|human)"
+    r"|qui es[ -]tu|qui etes[ -]vous|que fais[ -]tu|que faites[ -]vous|tu es qui|vous etes qui"
+)
+
+_GREETING_RE = re.compile(GREETING)
+_IDENTITY_RE = re.compile(rf"({GREETING} )?({IDENTITY})")
+_ACCENTS = str.maketrans("àâäéèêëîïôöùûüç", "aaaeeeeiioouuuc")
+_PUNCTUATION_RE = re.compile(r"[^\w\s'-]+")
+
+# Canned replies per language, keyed by what ChatRequest.language may hold
+LANGUAGES = {"english": "en", "en": "en", "french": "fr", "fr": "fr", "francais": "fr"}
+
+IDENTITY_REPLIES = {
+    "en": (
+        "I'm GpsLaw.AI, {user_name} — a legal guidance engine that works like a GPS of the Law. "
+        "I first locate your country and jurisdiction, then ask a few targeted questions about your "
+        "situation, and finally give you a clear priority action and what to expect next. "
+        "What legal issue can I help you with?"
+    ),
+    "fr": (
+        "Je suis GpsLaw.AI, {user_name} — un moteur d'orientation juridique qui fonctionne comme un GPS du droit. "
+        "Je détermine d'abord votre pays et votre juridiction, puis je vous pose quelques questions ciblées "
+        "sur votre situation, et enfin je vous indique l'action prioritaire et ce à quoi vous attendre. "
+        "Quel est votre problème juridique ?"
+    ),
+}
+FRENCH_GREETINGS = [
+    "Bonjour {user_name} ! Comment puis-je vous aider avec votre question juridique aujourd'hui ?",
+    "Bonjour {user_name} ! Décrivez-moi votre situation juridique et je ferai de mon mieux pour vous aider.",
+]
+
+
+def normalize(text: str) -> str:
+    text = text.lower().translate(_ACCENTS)
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+
+def classify(text: str) -> str | None:
+    """"greeting", "identity", or None when the message needs the model."""
+    text = normalize(text)
+    if _GREETING_RE.fullmatch(text):
+        return "greeting"
+    if _IDENTITY_RE.fullmatch(text):
+        return "identity"
+    return None
+
+
+def reply(intent: str, language: str | None, user_name: str, greeting: str) -> str | None:
+    """
+    Canned reply for `intent` in the session language, or None if there
+    is none for that language (the model then answers as usual).
+    `greeting` is the English greeting already picked for the session.
+    """
+    lang = LANGUAGES.get(normalize(language or "english"))
+    if lang is None:
+        return None
+    if intent == "greeting":
+        if lang == "en":
+            return greeting
+        return random.choice(FRENCH_GREETINGS).format(user_name=user_name)
+    return IDENTITY_REPLIES[lang].format(user_name=user_name)